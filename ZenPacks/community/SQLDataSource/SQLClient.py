@@ -22,14 +22,17 @@ log = logging.getLogger("zen.SQLClient")
 import Globals
 
 from Products.DataCollector.BaseClient import BaseClient
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, threads
+from twisted.internet.task import LoopingCall
 from twisted.python.failure import Failure
 from twisted.enterprise import adbapi
 from twisted.spread import pb
+from ZenPacks.community.SQLDataSource.Watchdog import getWatchdog
 
-import threading
+import time
 import sys
 import re
+import threading
 
 try:
     from Products.ZenCollector.pools import getPool
@@ -42,9 +45,134 @@ except ImportError:
         else:
             return SQLCLIENT_POOL
 
+MAX_QUERIES = 100
+FETCH_MIN = 100
+FETCH_MAX = 10000
+FETCH_CELLS = 200000
+WATCHDOG = getWatchdog()
+
+class QueryLimiter(object):
+    """
+    Limits the number of concurrently running queries per target, per DB-API
+    module and daemon-wide. Waiting queries are served round-robin between
+    targets, so a single slow target can't starve the others.
+    """
+
+    def __init__(self, maxQueries=MAX_QUERIES, driverLimits=None):
+        """
+        @type maxQueries: int
+        @param maxQueries: daemon-wide limit, 0 - unlimited
+        @type driverLimits: dictionary
+        @param driverLimits: DB-API module name as a key and limit as a value
+        """
+        self.maxQueries = maxQueries
+        self.driverLimits = driverLimits or {}
+        self._running = 0
+        self._targets = {}
+        self._drivers = {}
+        self._waiting = {}
+        self._order = []
+
+    def configure(self, maxQueries=None, driverLimits=None):
+        if maxQueries is not None:
+            self.maxQueries = maxQueries
+        if driverLimits is not None:
+            self.driverLimits = driverLimits
+        self._dispatch()
+
+    def _available(self, target, driver, limit):
+        if self.maxQueries and self._running >= self.maxQueries:
+            return False
+        if limit and self._targets.get(target, 0) >= limit:
+            return False
+        dlimit = self.driverLimits.get(driver)
+        if dlimit and self._drivers.get(driver, 0) >= dlimit:
+            return False
+        return True
+
+    def _take(self, target, driver):
+        self._running += 1
+        self._targets[target] = self._targets.get(target, 0) + 1
+        self._drivers[driver] = self._drivers.get(driver, 0) + 1
+
+    def acquire(self, target, driver, limit=0):
+        """
+        Returns deferred which fires when query is allowed to run.
+
+        @type target: string
+        @param target: connection target
+        @type driver: string
+        @param driver: DB-API module name
+        @type limit: int
+        @param limit: per target limit, 0 - unlimited
+        """
+        d = defer.Deferred()
+        if not self._waiting.get(target) and \
+            self._available(target, driver, limit):
+            self._take(target, driver)
+            d.callback(None)
+        else:
+            self._waiting.setdefault(target, []).append((driver, limit, d))
+            if target not in self._order:
+                self._order.append(target)
+        return d
+
+    def release(self, target, driver):
+        self._running -= 1
+        self._targets[target] -= 1
+        if not self._targets[target]:
+            del self._targets[target]
+        self._drivers[driver] -= 1
+        if not self._drivers[driver]:
+            del self._drivers[driver]
+        self._dispatch()
+
+    def _dispatch(self):
+        ready = []
+        progress = True
+        while progress and self._order:
+            progress = False
+            for i in range(len(self._order)):
+                target = self._order.pop(0)
+                queue = self._waiting[target]
+                driver, limit, d = queue[0]
+                if self._available(target, driver, limit):
+                    queue.pop(0)
+                    self._take(target, driver)
+                    ready.append(d)
+                    progress = True
+                if queue:
+                    self._order.append(target)
+                else:
+                    del self._waiting[target]
+        for d in ready:
+            d.callback(None)
+
+    def run(self, target, driver, limit, f, *args, **kwargs):
+        """
+        Run f when query is allowed to run.
+        """
+        def _run(ignored):
+            return defer.maybeDeferred(f, *args, **kwargs)
+        def _release(result):
+            self.release(target, driver)
+            return result
+        d = self.acquire(target, driver, limit)
+        d.addCallback(_run)
+        d.addBoth(_release)
+        return d
+
+QUERY_LIMITER = QueryLimiter()
+
+def getQueryLimiter():
+    return QUERY_LIMITER
+
 SEM_POOL = {}
 
 def getSemaphore(conn, connmax=None):
+    """
+    Deprecated, queries are limited by QUERY_LIMITER.
+    """
     global SEM_POOL
     if connmax is None:
         connmax = conn.max
@@ -59,57 +187,637 @@ class TimeoutError(Exception):
         Exception.__init__(self)
         self.args = args
 
+class CircuitOpenError(Exception):
+    """
+    Error for a connection to the target which failed recently
+    """
+
+    def __init__(self, *args):
+        Exception.__init__(self)
+        self.args = args
+
+    def __str__(self):
+        return ' '.join(map(str, self.args))
+
 CONN_LOCK = defer.DeferredLock()
 
+IDLE_TIMEOUT = 360
+PING_INTERVAL = 60
+BACKOFF_MIN = 30
+BACKOFF_MAX = 900
+SIDE_CONNECT_TIMEOUT = 5
+CANCEL_TIMEOUT = 10
+
+ARGPAT = re.compile(r"""\s*(?:
+    (?P<str>(?:[uU][rR]?|[rR])?(?:'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"))|
+    (?P<num>[+-]?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?[lL]?)|
+    (?P<name>[A-Za-z_]\w*)|
+    (?P<op>[=,\[\]()]))""", re.X | re.S)
+CONSTANTS = {'True': True, 'False': False, 'None': None}
+CLOSING = {'[': ']', '(': ')'}
+CS_CACHE = {}
+CS_CACHE_SIZE = 10000
+
+def _tokenize(text):
+    """
+    Split text in to (kind, value) tokens.
+    """
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = ARGPAT.match(text, pos)
+        if not m:
+            raise ValueError("Syntax error at position %s: %s"%(pos, text))
+        pos = m.end()
+        for kind in ('str', 'num', 'name', 'op'):
+            if m.group(kind) is not None:
+                tokens.append((kind, m.group(kind)))
+                break
+    return tokens
+
+def _literal(token):
+    """
+    Convert str, num or name token in to the python value.
+    """
+    kind, value = token
+    if kind == 'str':
+        prefix = value[:value.find(value[-1])].lower()
+        value = value[len(prefix) + 1:-1]
+        if prefix == 'r': return value
+        if prefix == 'ur': return value.decode('raw_unicode_escape')
+        if prefix == 'u': return value.decode('unicode_escape')
+        return value.decode('string_escape')
+    if kind == 'num':
+        if value[-1] in 'lL': return long(value[:-1])
+        try: return int(value)
+        except ValueError: return float(value)
+    if kind == 'name' and value in CONSTANTS:
+        return CONSTANTS[value]
+    raise ValueError("Unexpected token: %s"%value)
+
+def _value(tokens, pos):
+    """
+    Parse a value starting at pos, returns (value, next position).
+    """
+    if pos >= len(tokens):
+        raise ValueError("Unexpected end of string")
+    if tokens[pos] not in (('op', '['), ('op', '(')):
+        return _literal(tokens[pos]), pos + 1
+    closing = ('op', CLOSING[tokens[pos][1]])
+    items = []
+    comma = False
+    pos += 1
+    while pos < len(tokens) and tokens[pos] != closing:
+        value, pos = _value(tokens, pos)
+        items.append(value)
+        comma = pos < len(tokens) and tokens[pos] == ('op', ',')
+        if comma:
+            pos += 1
+        elif pos < len(tokens) and tokens[pos] != closing:
+            raise ValueError("Unexpected token: %s"%tokens[pos][1])
+    if pos >= len(tokens):
+        raise ValueError("Unexpected end of string")
+    if closing[1] == ')':
+        # parentheses without comma only group the value, like (1) == 1
+        if len(items) == 1 and not comma: return items[0], pos + 1
+        items = tuple(items)
+    return items, pos + 1
+
+def parseArguments(text):
+    """
+    Parse python function call arguments like "'a',1,b=True,c=['d']"
+    without eval.
+
+    @type text: string
+    @param text: arguments
+    @return: positional and keyword arguments
+    @rtype: tuple
+    """
+    tokens = _tokenize(text)
+    args = []
+    kwargs = {}
+    pos = 0
+    while pos < len(tokens):
+        if tokens[pos][0] == 'name' and tokens[pos+1:pos+2] == [('op','=')]:
+            name = tokens[pos][1]
+            if name in kwargs:
+                raise ValueError("Duplicate keyword argument: %s"%name)
+            kwargs[name], pos = _value(tokens, pos + 2)
+        elif kwargs:
+            raise ValueError("Positional argument follows keyword argument")
+        else:
+            value, pos = _value(tokens, pos)
+            args.append(value)
+        if pos < len(tokens):
+            if tokens[pos] != ('op', ','):
+                raise ValueError("Unexpected token: %s"%tokens[pos][1])
+            pos += 1
+    return args, kwargs
+
+def _parseLegacy(cs):
+    """
+    Connection string parser for strings which are not valid python
+    function call arguments.
+    """
+    args = []
+    kwargs = {}
+    for arg in cs.split(','):
+        try:
+            if arg.strip().startswith("'"):
+                arg = arg.strip("' ")
+                raise ValueError
+            var, val = arg.strip().split('=', 1)
+            if val.startswith('\'') or val.startswith('"'):
+                kwargs[var.strip()] = val.strip('\'" ')
+            elif val.lower() == 'true':
+                kwargs[var.strip()] = True
+            elif val.lower() == 'false':
+                kwargs[var.strip()] = False
+            else:
+                kwargs[var.strip()] = float(val.strip())
+        except: args.append(arg)
+    return args, kwargs
+
+def _parseCS(cs):
+    """
+    Returns cached normalized connection descriptor: tuple of positional
+    arguments and sorted tuple of keyword arguments.
+    """
+    descr = CS_CACHE.get(cs)
+    if descr is None:
+        try: args, kwargs = parseArguments(cs)
+        except ValueError: args, kwargs = _parseLegacy(cs)
+        items = kwargs.items()
+        items.sort()
+        descr = (tuple(args), tuple(items))
+        if len(CS_CACHE) >= CS_CACHE_SIZE:
+            CS_CACHE.clear()
+        CS_CACHE[cs] = descr
+    return descr
+
+def parseConnectionString(cs='', options={}):
+    args, items = _parseCS(cs)
+    kwargs = dict(items)
+    kwargs.update(options)
+    return list(args), kwargs
+
+def connectionKey(cs):
+    """
+    Returns key which is equal for equivalent connection strings.
+    """
+    return repr(_parseCS(cs))
+
 def delConnection(connectionString):
     pool = getPool('adbapi connections')
-    if hash(connectionString) in pool:
-        log.debug("delete pool %s", hash(connectionString))
-    d = CONN_LOCK.run(pool.pop, hash(connectionString), None)
+    key = connectionKey(connectionString)
+    if key in pool:
+        log.debug("delete pool %s", hash(key))
+    d = CONN_LOCK.run(pool.pop, key, None)
     d.addCallback(lambda conn: conn and conn.close() or None)
     return d
 
-def parseConnectionString(cs='', options={}):
-    try: args, kwargs = eval('(lambda *args,**kwargs:(args,kwargs))(%s)'%cs)
-    except:
-        args = []
-        kwargs = {}
-        for arg in cs.split(','):
-            try:
-                if arg.strip().startswith("'"):
-                    arg = arg.strip("' ")
-                    raise
-                var, val = arg.strip().split('=', 1)
-                if val.startswith('\'') or val.startswith('"'):
-                    kwargs[var.strip()] = val.strip('\'" ')
-                elif val.lower() == 'true':
-                    kwargs[var.strip()] = True
-                elif val.lower() == 'false':
-                    kwargs[var.strip()] = False
-                else:
-                    kwargs[var.strip()] = float(val.strip())
-            except: args.append(arg)
-    kwargs.update(options)
-    return args, kwargs
+def _callInThread(function, *args):
+    """
+    Run blocking cancellation in the reactor thread pool, so the watchdog
+    never waits for the database server. Returns event which is set when
+    the cancellation completes.
+    """
+    finished = threading.Event()
+    def _run():
+        try:
+            function(*args)
+        finally:
+            finished.set()
+    if not reactor.running:
+        _run()
+        return finished
+    def _failed(reason):
+        log.debug("query cancellation failed: %s", reason.getErrorMessage())
+    def _call():
+        threads.deferToThread(_run).addErrback(_failed)
+    reactor.callFromThread(_call)
+    return finished
+
+def _runSideConnection(pool, sql):
+    args, kwargs = tuple(pool.connargs), dict(pool.connkw)
+    if pool.dbapiName == 'psycopg2' and args and \
+        isinstance(args[0], basestring):
+        args = ('%s connect_timeout=%d'%(args[0], SIDE_CONNECT_TIMEOUT),) + \
+                                                                    args[1:]
+    else:
+        kwargs['connect_timeout'] = SIDE_CONNECT_TIMEOUT
+    connection = pool.dbapi.connect(*args, **kwargs)
+    try:
+        cursor = connection.cursor()
+        cursor.execute(sql)
+        cursor.close()
+    finally:
+        connection.close()
+
+def _sideConnection(pool, sql):
+    """
+    Run sql statement over new connection with the same parameters.
+    """
+    return _callInThread(_runSideConnection, pool, sql)
+
+def _killMySQLQuery(cursor, connection, pool):
+    return _sideConnection(pool, 'KILL QUERY %d'%connection.thread_id())
+
+def _cancelPgQuery(cursor, connection, pool):
+    if hasattr(connection, 'cancel'):
+        return _callInThread(connection.cancel)
+    else:
+        return _sideConnection(pool, 'SELECT pg_cancel_backend(%d)'%(
+                                            connection.get_backend_pid()))
+
+def _interruptSQLiteQuery(cursor, connection, pool):
+    connection.interrupt()
+
+CANCELLERS = {
+    'MySQLdb': _killMySQLQuery,
+    'pymysql': _killMySQLQuery,
+    'psycopg2': _cancelPgQuery,
+    'sqlite3': _interruptSQLiteQuery,
+    'pysqlite2.dbapi2': _interruptSQLiteQuery,
+}
+
+def cancelQuery(txn):
+    """
+    Cancel the query currently running by txn with the best mechanism
+    available for DB-API module: KILL QUERY for MySQL, cancel request for
+    PostgreSQL, interrupt() for SQLite and cursor.cancel() for pyodbc and
+    bundled modules. The cursor will be closed if nothing else helps.
+    Cancellations which connect to the server run in the reactor thread
+    pool, for them event which is set on completion is returned.
+
+    @param txn: database cursor
+    @type txn: dbapi.cursor or adbapi.Transaction
+    """
+    cursor = getattr(txn, '_cursor', txn)
+    pool = getattr(txn, '_pool', None)
+    connection = getattr(getattr(txn, '_connection', None), '_connection', None)
+    canceller = pool is not None and CANCELLERS.get(pool.dbapiName)
+    try:
+        if canceller and connection is not None:
+            return canceller(cursor, connection, pool)
+        elif hasattr(cursor, 'cancel'):
+            return cursor.cancel()
+    except Exception, ex:
+        log.debug("query cancellation failed: %s", ex)
+    cursor.close()
+
+class PoolManager(object):
+    """
+    Keeps adbapiClient connections warm between collection cycles. Closes
+    connections which stay idle longer than idleTimeout and checks liveness
+    of the remaining ones every pingInterval seconds.
+    """
+
+    def __init__(self, idleTimeout=IDLE_TIMEOUT, pingInterval=PING_INTERVAL):
+        """
+        @type idleTimeout: int
+        @param idleTimeout: seconds before idle connection will be closed
+        @type pingInterval: int
+        @param pingInterval: seconds between liveness checks
+        """
+        self.idleTimeout = idleTimeout
+        self.pingInterval = pingInterval
+        self._loop = None
+
+    def configure(self, idleTimeout=None, pingInterval=None):
+        if idleTimeout is not None:
+            self.idleTimeout = idleTimeout
+        if pingInterval is not None and pingInterval != self.pingInterval:
+            self.pingInterval = pingInterval
+            if self._loop is not None:
+                self.stop()
+                self.start()
+
+    def start(self):
+        if self._loop is None:
+            self._loop = LoopingCall(self.check)
+            self._loop.start(self.pingInterval, now=False)
+
+    def stop(self):
+        if self._loop is not None:
+            loop, self._loop = self._loop, None
+            if loop.running:
+                loop.stop()
+
+    def check(self):
+        """
+        Close idle and broken connections, ping the remaining ones.
+        """
+        pool = getPool('adbapi connections')
+        now = time.time()
+        for key, client in pool.items():
+            client.shrink(now - self.pingInterval)
+            if client.busy: continue
+            if isinstance(client._connection, Failure) or \
+                now - client.lastUsed > max(self.idleTimeout,client.idleTimeout):
+                log.debug("close idle pool %s", key)
+                delConnection(client.cs)
+            elif client._connection is not None and \
+                now - client.lastPing >= self.pingInterval:
+                client.ping()
+
+POOL_MANAGER = PoolManager()
+
+def getPoolManager():
+    return POOL_MANAGER
+
+class CircuitBreaker(object):
+    """
+    Fails connection attempts to the unreachable target immediately.
+    After a connection failure the breaker is open for the backoff time,
+    then single probe connection is allowed (half-open state). Backoff
+    is doubled after every failed probe up to maxBackoff.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, minBackoff=BACKOFF_MIN, maxBackoff=BACKOFF_MAX):
+        """
+        @type minBackoff: int
+        @param minBackoff: seconds before the first probe
+        @type maxBackoff: int
+        @param maxBackoff: max seconds between probes
+        """
+        self.minBackoff = minBackoff
+        self.maxBackoff = maxBackoff
+        self.state = self.CLOSED
+        self.failures = 0
+        self.retryAt = 0
+        self.error = ''
+
+    def allow(self):
+        """
+        Returns True if connection attempt is allowed.
+        """
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.time() >= self.retryAt:
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def success(self, result):
+        self.state = self.CLOSED
+        self.failures = 0
+        return result
+
+    def failure(self, result):
+        if self.state != self.OPEN:
+            self.failures += 1
+            self.state = self.OPEN
+            self.retryAt = time.time() + min(self.maxBackoff,
+                                self.minBackoff * 2 ** (self.failures - 1))
+            self.error = result.getErrorMessage()
+        return result
+
+BREAKERS = {}
+BREAKERS_SIZE = 10000
+
+def getCircuitBreaker(key):
+    breaker = BREAKERS.get(key)
+    if breaker is None:
+        if len(BREAKERS) >= BREAKERS_SIZE:
+            # closed breakers carry no state, forget them first
+            for k, b in BREAKERS.items():
+                if b.state == b.CLOSED: del BREAKERS[k]
+            if len(BREAKERS) >= BREAKERS_SIZE:
+                BREAKERS.clear()
+        breaker = BREAKERS[key] = CircuitBreaker()
+    return breaker
+
+STMTPAT = re.compile('[ \n]go[ \n]|;[ \n]', re.I)
+ROWLESS_STATEMENTS = ('USE ', 'SET ', 'DECLARE ')
+STMT_CACHE = {}
+STMT_CACHE_SIZE = 10000
+MULTI_STATEMENTS = 1 << 16
+
+def splitStatements(sql):
+    """
+    Split sql in to statements. Returns cached tuple of statements list
+    and a single batch statement, which is None if statements can't be
+    sent at once because not only the last statement returns rows.
+
+    @param sql: sql operation
+    @type sql: string
+    @rtype: tuple
+    """
+    result = STMT_CACHE.get(sql)
+    if result is None:
+        statements = [q.strip() for q in STMTPAT.split(sql) if q.strip()]
+        batch = None
+        if len(statements) > 1 and not [q for q in statements[:-1] \
+            if not q.upper().startswith(ROWLESS_STATEMENTS)]:
+            batch = ';\n'.join(statements)
+        result = (statements, batch)
+        if len(STMT_CACHE) >= STMT_CACHE_SIZE:
+            STMT_CACHE.clear()
+        STMT_CACHE[sql] = result
+    return result
+
+def supportsBatch(args, kwargs):
+    """
+    Check if DB-API module can execute multiple statements at once and
+    skip results of the leading statements with nextset().
+    """
+    if not args:
+        return False
+    if args[0] == 'pymssql':
+        return True
+    if args[0] == 'pyodbc':
+        return 'sql server' in ' '.join(map(str, args[1:])).lower()
+    if args[0] == 'MySQLdb':
+        return bool(int(kwargs.get('client_flag', 0)) & MULTI_STATEMENTS)
+    return False
+
+def _identity(val):
+    return val
+
+def _toNumber(val):
+    if val is None: return 0
+    if not val or isinstance(val, (int, long, float)): return val
+    if str(val).isdigit(): return long(val)
+    if str(val).replace('.', '', 1).isdigit(): return float(val)
+    return val
+
+def _toString(val):
+    if val is None: return ''
+    return str(val).strip()
+
+def _toNumberOrString(val):
+    if val is None: return ''
+    if val: return _toNumber(val)
+    return str(val).strip()
+
+def splitKeybindings(keybindings):
+    """
+    Returns keybinding column names and the key of the matching rows.
+
+    @param keybindings: column name as a key and expected value as a value
+    @type keybindings: dictionary
+    @rtype: tuple
+    """
+    if not keybindings:
+        return (), ''
+    kc, kv = zip(*[map(lambda v: str(v).strip().lower(), k) \
+                                        for k in keybindings.iteritems()])
+    return kc, ''.join(kv)
+
+def rowKey(row, keys):
+    """
+    Returns stripped, lower-cased and concatenated values of the columns.
+
+    @param row: result row
+    @type row: tuple
+    @param keys: column indexes, None for missing columns
+    @type keys: tuple
+    """
+    return ''.join([str(i is not None and row[i] or '').strip() \
+                                                    for i in keys]).lower()
+
+class ResultSet(object):
+    """
+    Query results with a single column name to column index map and rows
+    stored as tuples. Default query results consumer. Iteration and
+    indexing return rows as dictionaries like the list of dictionaries
+    returned before, use rows attribute to access the tuples.
+    """
+
+    def __init__(self, header=(), rows=None):
+        self.start(header)
+        self.rows = rows or []
+        self._groups = {}
+
+    def start(self, header):
+        self.header = tuple(header)
+        self.index = {}
+        for i, column in enumerate(self.header):
+            self.index[column] = i
+
+    def feed(self, rows):
+        self.rows.extend(rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        header = self.header
+        for row in self.rows:
+            yield dict(zip(header, row))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [dict(zip(self.header, row)) for row in self.rows[i]]
+        return dict(zip(self.header, self.rows[i]))
+
+    def __str__(self):
+        return str(self.asDicts())
+
+    def groupBy(self, columns):
+        """
+        Returns dictionary with the row keys of the columns as keys and
+        lists of the rows as values. Rows are indexed only once for the
+        same columns.
+        """
+        keys = tuple([self.index.get(c) for c in columns])
+        groups = self._groups.get(keys)
+        if groups is None:
+            groups = self._groups[keys] = {}
+            if not [i for i in keys if i is not None]:
+                groups[''] = list(self.rows)
+            else:
+                for row in self.rows:
+                    key = rowKey(row, keys)
+                    if key in groups: groups[key].append(row)
+                    else: groups[key] = [row]
+        return groups
+
+    def getter(self, column, default=None):
+        """
+        Returns function which returns column value of the row.
+        """
+        i = self.index.get(column)
+        if i is None:
+            return lambda row: default
+        return lambda row: row[i]
+
+    def select(self, rows):
+        """
+        Returns new ResultSet with the same header and selected rows.
+        """
+        result = ResultSet()
+        result.header = self.header
+        result.index = self.index
+        result.rows = rows
+        return result
+
+    def asDicts(self):
+        """
+        Returns rows as dictionaries with column names as keys.
+        """
+        header = self.header
+        return [dict(zip(header, row)) for row in self.rows]
 
 class adbapiClient(object):
 
+    fetchMin = FETCH_MIN
+    fetchMax = FETCH_MAX
+    fetchCells = FETCH_CELLS
+
     def __init__(self, cs):
         """
         @type cs: string
         @param cs: connection string
         """
         self.cs = cs
+        self.key = connectionKey(cs)
+        self.min = 1
+        self.max = 1
         self._connection = None
         self._dbapi = None
-        self._autoclose = None
+        self._args = ()
+        self._kwargs = {}
+        self._pools = []
+        self._idle = []
+        self._waiting = []
+        self._growing = 0
+        self._active = 0
+        self._converters = {}
+        self._fetchSizes = {}
+        self._batch = False
         self._lock = defer.DeferredLock()
+        self.idleTimeout = 0
+        self.lastUsed = time.time()
+        self.lastPing = self.lastUsed
 
     def __del__(self):
         if self._connection:
             self.close()
 
+    @property
+    def busy(self):
+        return self._active > 0
+
+    def touch(self, keepalive=0):
+        """
+        Mark connection as used.
+
+        @type keepalive: int
+        @param keepalive: minimal seconds to keep connection open while idle
+        """
+        self.lastUsed = time.time()
+        if keepalive > self.idleTimeout:
+            self.idleTimeout = keepalive
+
     def connect(self):
+        self.touch()
         return self._lock.run(self._connect)
 
     def _connect(self):
@@ -117,47 +825,238 @@ class adbapiClient(object):
             return defer.fail(self._connection)
         elif self._connection and self._dbapi:
             return defer.succeed(self)
-        if self._autoclose is None:
-            self._autoclose = reactor.callLater(360, delConnection, self.cs)
         args, kwargs = parseConnectionString(self.cs)
-        if 'cp_min' not in kwargs:
-            kwargs['cp_min'] = 1
-        connmax = kwargs.get('cp_max', 5)
-        kwargs['cp_max'] = kwargs['cp_min']
-        self._connection = adbapi.ConnectionPool(*args, **kwargs)
-        semaphore = getSemaphore(self._connection, connmax)
-        def _connected(result):
-            self._dbapi = getattr(self._connection, 'dbapi', None)
+        self.min = max(int(kwargs.get('cp_min', 1)), 1)
+        self.max = max(int(kwargs.get('cp_max', 5)), self.min)
+        if 'cp_reconnect' not in kwargs:
+            kwargs['cp_reconnect'] = True
+        # every adbapi pool holds a single connection, the client opens
+        # additional pools while queries are waiting for a free connection
+        kwargs['cp_min'] = kwargs['cp_max'] = 1
+        self._args, self._kwargs = args, kwargs
+        self._batch = supportsBatch(args, kwargs)
+        def _connected(pool):
+            self._connection = pool
+            self._dbapi = getattr(pool, 'dbapi', None)
+            self.lastPing = time.time()
+            self._pools.append(pool)
+            self._release(pool)
+            for i in range(self.min - 1):
+                self._grow()
             return self
         def _notConnected(result):
-            self._connection.close()
             self._connection = result
             return result
-        d = self._connection.runQuery(self._connection.good_sql)
+        d = self._newPool()
         d.addCallbacks(_connected, _notConnected)
         return d
 
+    def _newPool(self):
+        """
+        Open a single connection adbapi pool.
+        """
+        pool = adbapi.ConnectionPool(*self._args, **self._kwargs)
+        def _failed(reason):
+            pool.close()
+            return reason
+        d = pool.runQuery(pool.good_sql)
+        d.addCallbacks(lambda result: pool, _failed)
+        return d
+
+    def _grow(self):
+        """
+        Open an additional connection.
+        """
+        self._growing += 1
+        def _added(pool):
+            self._growing -= 1
+            if self._connection is None or \
+                isinstance(self._connection, Failure):
+                pool.close()
+                return
+            log.debug("grow pool to %s connections", len(self._pools) + 1)
+            self._pools.append(pool)
+            self._release(pool)
+        def _failed(reason):
+            self._growing -= 1
+            log.debug("can't open connection: %s", reason.getErrorMessage())
+            if self._pools or self._growing: return
+            waiting, self._waiting = self._waiting, []
+            for d in waiting:
+                d.errback(reason)
+        self._newPool().addCallbacks(_added, _failed)
+
+    def shrink(self, idleSince):
+        """
+        Close connections which are idle since idleSince, but keep
+        at least cp_min connections open.
+
+        @type idleSince: float
+        @param idleSince: timestamp
+        """
+        for lastUsed, pool in self._idle[:]:
+            if len(self._pools) <= self.min: break
+            if lastUsed > idleSince: continue
+            log.debug("shrink pool to %s connections", len(self._pools) - 1)
+            self._remove(pool)
+
+    def _remove(self, pool):
+        """
+        Close single connection.
+        """
+        if pool in self._pools:
+            self._pools.remove(pool)
+        for item in self._idle:
+            if item[1] is pool:
+                self._idle.remove(item)
+                break
+        if pool is self._connection:
+            self._connection = self._pools and self._pools[0] or None
+        pool.close()
+
+    def _acquire(self):
+        """
+        Returns deferred which fires with free connection.
+        """
+        if self._idle:
+            return defer.succeed(self._idle.pop()[1])
+        d = defer.Deferred()
+        self._waiting.append(d)
+        if len(self._pools) + self._growing < self.max:
+            self._grow()
+        return d
+
+    def _release(self, pool):
+        """
+        Return connection back to the client.
+        """
+        if pool not in self._pools:
+            return
+        if self._waiting:
+            self._waiting.pop(0).callback(pool)
+        else:
+            self._idle.append((time.time(), pool))
+
     def close(self):
-        if self._connection:
-            connection, self._connection = self._connection, None
-            if not isinstance(connection, Failure):
-                connection.close()
+        connection, self._connection = self._connection, None
+        pools, self._pools = self._pools, []
+        waiting, self._waiting = self._waiting, []
+        del self._idle[:]
+        self._dbapi = None
+        for d in waiting:
+            d.errback(Failure(Exception('Connection lost')))
+        if connection is not None and connection not in pools and \
+            not isinstance(connection, Failure):
+            connection.close()
+        for pool in pools:
+            pool.close()
+
+    def ping(self):
+        """
+        Check liveness of idle connections and reconnect if all connections
+        are broken.
+        """
+        if self._connection is None or isinstance(self._connection, Failure):
+            return defer.succeed(self)
+        self.lastPing = time.time()
+        idle, self._idle = self._idle, []
+        return self._ping(idle)
 
-    def _convert(self, val, type):
-        if val is None:
-            if type == self._dbapi.STRING: return ''
-            if type == self._dbapi.NUMBER: return 0
+    def _ping(self, items):
+        """
+        Check liveness of the connections, broken connections are closed.
+
+        @type items: list
+        @param items: list of (lastUsed, pool) tuples
+        """
+        def _pong(result, lastUsed, pool):
+            if isinstance(result, Failure):
+                log.debug("ping failed: %s", result.getErrorMessage())
+                self._remove(pool)
+            elif pool not in self._pools:
+                return
+            elif self._waiting:
+                self._waiting.pop(0).callback(pool)
+            else:
+                self._idle.append((lastUsed, pool))
+        def _reconnect(result):
+            if self._connection is not None:
+                return self
+            log.debug("all connections are broken, reconnect")
+            self.close()
+            return self._lock.run(self._connect)
+        def _failed(reason):
+            log.debug("reconnect failed: %s", reason.getErrorMessage())
             return None
-        if val and type == self._dbapi.NUMBER:
-            if isinstance(val, (int, long, float)): return val
-            if str(val).isdigit(): return long(val)
-            if str(val).replace('.', '', 1).isdigit(): return float(val)
-            return val
-        if type == self._dbapi.STRING:
-            return str(val).strip()
-        return val
+        pings = []
+        for lastUsed, pool in items:
+            d = pool.runQuery(pool.good_sql)
+            d.addBoth(_pong, lastUsed, pool)
+            pings.append(d)
+        d = defer.DeferredList(pings)
+        d.addCallback(_reconnect)
+        d.addErrback(_failed)
+        return d
+
+    def _connectionError(self, reason):
+        """
+        Returns True if the query failed because of broken connection.
+        """
+        errors = [getattr(self._dbapi, n, None) for n in ('OperationalError',
+                                                        'InterfaceError')]
+        errors = [e for e in errors if e is not None]
+        return bool(errors) and reason.check(*errors) is not None
+
+    def _columnConverter(self, type):
+        """
+        Returns conversion function for column values of the type.
+        """
+        if self._dbapi is None:
+            return _identity
+        isString = type == self._dbapi.STRING
+        isNumber = type == self._dbapi.NUMBER
+        if isString and isNumber: return _toNumberOrString
+        if isNumber: return _toNumber
+        if isString: return _toString
+        return _identity
+
+    def _convert(self, val, type):
+        """
+        Deprecated, use _columnConverter(type) to convert many values.
+        """
+        return self._columnConverter(type)(val)
 
-    def runQuery(self, txn, sql, columns, timeout):
+    def _rowConverter(self, description):
+        """
+        Returns cached conversion function for rows with the description.
+        """
+        try:
+            key = tuple([(d[0], d[1]) for d in description])
+            convert = self._converters.get(key)
+        except TypeError:
+            key = convert = None
+        if convert is not None:
+            return convert
+        convs = tuple([self._columnConverter(d[1]) for d in description])
+        if [c for c in convs if c is not _identity]:
+            convert = lambda row: tuple([c(v) for c, v in zip(convs, row)])
+        else:
+            convert = tuple
+        if key is not None:
+            self._converters[key] = convert
+        return convert
+
+    def _fetchSize(self, sql, width):
+        """
+        Returns initial and maximal fetch size for the query, based on the
+        number of rows returned by the previous run and row width.
+        """
+        maxSize = min(self.fetchMax, self.fetchCells // max(width, 1))
+        maxSize = max(maxSize, self.fetchMin)
+        size = self._fetchSizes.get(sql, self.fetchMin)
+        return max(min(size, maxSize), self.fetchMin), maxSize
+
+    def runQuery(self, txn, sql, columns, timeout, consumer=None):
         """
         execute a sql query.
 
@@ -169,60 +1068,124 @@ class adbapiClient(object):
         @type columns: list
         @param timeout: timeout in seconds
         @type timeout: int
+        @param consumer: receives header and batches of fetched rows
+        @type consumer: object with start(header) and feed(rows) methods
+        @return: consumer
+        @rtype: ResultSet by default
         """
-        res = []
-        def _timeout():
-            if hasattr(txn, '_cursor'):
-                txn._cursor.close()
-            else:
-                txn.close()
-        t = threading.Timer(timeout, _timeout)
-        t.start()
+        if consumer is None:
+            consumer = ResultSet()
+        statements, batch = splitStatements(sql)
+        if batch and self._batch:
+            statements = (batch,)
+        t = WATCHDOG.schedule(timeout, cancelQuery, txn)
         try:
-            for q in re.split('[ \n]go[ \n]|;[ \n]', sql, re.I):
-                if not q.strip(): continue
-                txn.execute(q.strip())
+            for q in statements:
+                txn.execute(q)
+            if len(statements) == 1 and batch and self._batch:
+                # skip results of the statements which don't return rows
+                while txn.description is None and txn.nextset(): pass
         except Exception, ex:
-            if t.isAlive():
-                t.cancel()
-            else:
-                ex = TimeoutError('Timeout')
+            t.cancel()
+            if t.expired:
+                ex = self._timedOut(txn, t)
             raise ex
         t.cancel()
+        if t.expired:
+            # query completed after the deadline, but cancellation is
+            # already on the way
+            raise self._timedOut(txn, t)
         if not txn.description:
-            return res
+            return consumer
         header = [h[0].lower() for h in txn.description]
-        ct = [h[1] for h in txn.description]
+        convert = self._rowConverter(txn.description)
         if set(columns).intersection(set(header)):
-            varVal = False
+            varVal = None
+            consumer.start(header)
         else:
-            res.append({})
-            varVal = True
-        rows = txn.fetchmany()
-        while rows:
-            for row in rows:
-                if varVal:
-                    res[0][str(row[0]).lower()] = self._convert(row[-1], ct[-1])
-                else:
-                    res.append(dict(zip(header,
-                                    [self._convert(*v) for v in zip(row,ct)])))
-            rows = txn.fetchmany()
-        return res
-
-    def query(self, task):
+            varVal = {}
+            lastConvert = self._columnConverter(txn.description[-1][1])
+        size, maxSize = self._fetchSize(sql, len(header))
+        cursor = getattr(txn, '_cursor', txn)
+        count = 0
+        while True:
+            try: cursor.arraysize = size
+            except: pass
+            rows = txn.fetchmany(size)
+            if not rows: break
+            count += len(rows)
+            if varVal is not None:
+                for row in rows:
+                    varVal[str(row[0]).lower()] = lastConvert(row[-1])
+            else:
+                consumer.feed(map(convert, rows))
+            if len(rows) >= size and size < maxSize:
+                size = min(size * 2, maxSize)
+        self._fetchSizes[sql] = count + 1
+        if varVal is not None:
+            consumer.start(varVal.keys())
+            consumer.feed([tuple(varVal.values())])
+        return consumer
+
+    def _timedOut(self, txn, deadline):
+        """
+        Wait until the cancellation of the timed out query completes, so it
+        can't cancel the next query of the connection. The connection is
+        reopened if cancellation doesn't complete in CANCEL_TIMEOUT seconds.
+        Returns TimeoutError.
+        """
+        waitUntil = time.time() + CANCEL_TIMEOUT
+        finished = deadline.wait(CANCEL_TIMEOUT)
+        pending = deadline.result
+        if finished and pending is not None:
+            pending.wait(max(waitUntil - time.time(), 0))
+            finished = pending.isSet()
+        if not finished:
+            log.warn("Query cancellation didn't complete in %s seconds, "
+                                                "reconnect", CANCEL_TIMEOUT)
+            reconnect = getattr(txn, 'reconnect', None)
+            if reconnect is not None:
+                reconnect()
+        return TimeoutError('Timeout')
+
+    def query(self, task, consumer=None):
         """
         execute a sql query.
 
         @param task: task to run
         @type task: DataSourceConfig
+        @param consumer: receives header and batches of fetched rows
+        @type consumer: object with start(header) and feed(rows) methods
         """
         if isinstance(self._connection, Failure):
             return defer.fail(self._connection)
         elif self._connection is None:
             return defer.fail(Exception('Connection lost'))
-        semaphore = getSemaphore(self._connection)
-        return semaphore.run(self._connection.runInteraction, self.runQuery,
-                                        task.sqlp, task.columns, task.timeout)
+        def _finished(result):
+            self._active -= 1
+            self.touch()
+            return result
+        self._active += 1
+        d = QUERY_LIMITER.run(self.key, self._args[0], self.max,
+                                            self._runQuery, task, consumer)
+        d.addBoth(_finished)
+        return d
+
+    def _runQuery(self, task, consumer):
+        def _run(pool):
+            d = pool.runInteraction(self.runQuery, task.sqlp, task.columns,
+                                                    task.timeout, consumer)
+            d.addBoth(_done, pool)
+            return d
+        def _done(result, pool):
+            if isinstance(result, Failure) and pool in self._pools and \
+                self._connectionError(result):
+                # check only the connection which failed the query
+                self._ping([(time.time(), pool)])
+            else:
+                self._release(pool)
+            return result
+        return self._acquire().addCallback(_run)
 
 
 class dbapiClient(adbapiClient):
@@ -230,6 +1193,8 @@ class dbapiClient(adbapiClient):
     def connect(self):
         fl = []
         args, kwargs = parseConnectionString(self.cs)
+        self._args, self._kwargs = args, kwargs
+        self._batch = supportsBatch(args, kwargs)
         if '.' in args[0]:
             fl.append(args[0].split('.')[-1])
         dbapi = __import__(args[0], globals(), locals(), fl)
@@ -258,13 +1223,31 @@ class dbapiClient(adbapiClient):
 
 def getConnection(connectionString):
     pool = getPool('adbapi connections')
-    if hash(connectionString) not in pool:
-        log.debug("create pool %s", hash(connectionString))
-    d = CONN_LOCK.run(pool.setdefault, hash(connectionString),
-                            adbapiClient(connectionString))
+    key = connectionKey(connectionString)
+    breaker = getCircuitBreaker(key)
+    if not breaker.allow():
+        return defer.fail(CircuitOpenError('Connection failed:', breaker.error))
+    if key not in pool:
+        log.debug("create pool %s", hash(key))
+    elif breaker.state == breaker.HALF_OPEN and \
+        isinstance(pool[key]._connection, Failure):
+        # probe with new connection instead of cached failure
+        del pool[key]
+    POOL_MANAGER.start()
+    d = CONN_LOCK.run(pool.setdefault, key, adbapiClient(connectionString))
     d.addCallback(lambda conn: conn.connect())
+    d.addCallbacks(breaker.success, breaker.failure)
     return d
 
+def releaseConnection(connectionString):
+    """
+    Allow the pool manager to close connection as soon as it becomes idle.
+    """
+    conn = getPool('adbapi connections').get(connectionKey(connectionString))
+    if conn is not None:
+        conn.idleTimeout = 0
+    return defer.succeed(None)
+
 class DataPointConfig(pb.Copyable, pb.RemoteCopy):
     """
     Represents data point
@@ -421,11 +1404,9 @@ class SQLClient(BaseClient):
             def _connected(connection, dsc):
                 if isinstance(connection, Failure):
                     d = defer.fail(connection)
-                elif connection._autoclose.active():
-                    connection._autoclose.reset(305)
-                    d = connection.query(dsc)
                 else:
-                    d = defer.fail(Exception("Connection close"))
+                    connection.touch()
+                    d = connection.query(dsc)
                 d.addBoth(self._finished, dsc)
             dsc = self._taskQueue[0]
             c = getConnection(dsc.connectionString)
@@ -443,17 +1424,9 @@ class SQLClient(BaseClient):
             if isinstance(results, Failure):
                 task.result.errback(results.getErrorMessage())
                 continue
-            if task.keybindings:
-                kc, kv = zip(*[map(lambda v: str(v).strip().lower(), k) \
-                                    for k in task.keybindings.iteritems()])
-                kv = ''.join(kv)
-            else: kc, kv = (), ''
-            result = []
-            for row in results:
-                if ''.join([str(row.get(k) or '').strip() for k in kc]
-                                                    ).lower() != kv: continue
-                result.append(row)
-            task.result.callback(result)
+            kc, kv = splitKeybindings(task.keybindings)
+            rows = results.groupBy(kc).get(kv, [])
+            task.result.callback(results.select(rows))
         self._running = False
         reactor.callLater(0, self._runTask)
 
@@ -481,7 +1454,7 @@ class SQLClient(BaseClient):
         results of the collection run
 
         @param result: result from the collection run
-        @type result: list
+        @type result: ResultSet
         @param datasource: data source config
         @type datasource: DataSourceConfig
         @param pName: plugin name
@@ -494,11 +1467,13 @@ class SQLClient(BaseClient):
                                                     result.getErrorMessage())
             return (table, result)
         log.debug('Results for %s query "%s": %s', pName, datasource.sql,
-                                                                    str(result))
-        if datasource.points:
-            result = [dict([(p.id,row.get(p.alias,'')) \
-                                for p in datasource.points]) for row in result]
-        return (table, result)
+                                                                        result)
+        if not datasource.points:
+            return (table, result.asDicts())
+        getters = [(p.id, result.getter(p.alias, '')) \
+                                                for p in datasource.points]
+        return (table, [dict([(pid, g(row)) for pid, g in getters]) \
+                                                        for row in result.rows])
 
 
     def collectComplete(self, r, plugin):
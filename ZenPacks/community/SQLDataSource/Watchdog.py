@@ -0,0 +1,155 @@
+################################################################################
+#
+# This program is part of the SQLDataSource Zenpack for Zenoss.
+# Copyright (C) 2013 Egor Puzanov.
+#
+# This program can be used under the GNU General Public License version 2
+# You can find full information here: http://www.zenoss.com/oss
+#
+################################################################################
+
+__doc__="""Watchdog
+
+Single thread deadline scheduler for query timeouts, expired calls are
+dispatched to a separate caller thread.
+
+$Id: Watchdog.py,v 1.0 2013/04/02 12:00:00 egor Exp $"""
+
+__version__ = "$Revision: 1.0 $"[11:-2]
+
+import logging
+log = logging.getLogger("zen.Watchdog")
+
+import threading
+import heapq
+import time
+import Queue
+
+
+class Deadline(object):
+    """
+    Scheduled call, has the same cancel() and isAlive() methods as
+    threading.Timer.
+    """
+
+    def __init__(self, watchdog, deadline, function, args):
+        self._watchdog = watchdog
+        self.deadline = deadline
+        self.function = function
+        self.args = args
+        self.cancelled = False
+        self.expired = False
+        self.result = None
+        self._called = threading.Event()
+
+    def isAlive(self):
+        """
+        True while deadline is not expired and not cancelled.
+        """
+        return not (self.expired or self.cancelled)
+
+    def cancel(self):
+        """
+        Cancel the call if deadline is not expired yet.
+        """
+        self._watchdog._cancel(self)
+
+    def wait(self, timeout=None):
+        """
+        Wait until the call of expired deadline returns, its return value
+        is kept in the result attribute. Returns True if the call returned.
+        """
+        self._called.wait(timeout)
+        return self._called.isSet()
+
+
+class Watchdog(object):
+    """
+    Watches deadlines in a single daemon thread and runs expired calls in
+    the caller thread, so slow call never delays other deadlines.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._calls = Queue.Queue()
+        self._caller = None
+        self._seq = 0
+        self.scheduled = 0
+        self.expired = 0
+
+    def schedule(self, timeout, function, *args):
+        """
+        Call function(*args) after timeout seconds.
+
+        @type timeout: float
+        @param timeout: seconds
+        @return: scheduled call
+        @rtype: Deadline
+        """
+        deadline = Deadline(self, time.time() + timeout, function, args)
+        self._cond.acquire()
+        try:
+            self._seq += 1
+            self.scheduled += 1
+            heapq.heappush(self._heap, (deadline.deadline, self._seq, deadline))
+            if self._thread is None or not self._thread.isAlive():
+                self._thread = threading.Thread(target=self._run,
+                                                name='SQLClientWatchdog')
+                self._thread.setDaemon(True)
+                self._thread.start()
+            if self._caller is None or not self._caller.isAlive():
+                self._caller = threading.Thread(target=self._call,
+                                                name='SQLClientWatchdogCaller')
+                self._caller.setDaemon(True)
+                self._caller.start()
+            elif self._heap[0][2] is deadline:
+                self._cond.notify()
+        finally:
+            self._cond.release()
+        return deadline
+
+    def _cancel(self, deadline):
+        self._cond.acquire()
+        try:
+            if not deadline.expired:
+                deadline.cancelled = True
+        finally:
+            self._cond.release()
+
+    def _run(self):
+        self._cond.acquire()
+        try:
+            while True:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                timeout = self._heap[0][0] - time.time()
+                if timeout > 0:
+                    self._cond.wait(timeout)
+                    continue
+                deadline = heapq.heappop(self._heap)[2]
+                deadline.expired = True
+                self.expired += 1
+                self._calls.put(deadline)
+        finally:
+            self._cond.release()
+
+    def _call(self):
+        while True:
+            deadline = self._calls.get()
+            try:
+                try:
+                    deadline.result = deadline.function(*deadline.args)
+                except Exception:
+                    log.exception("Watchdog call failed")
+            finally:
+                deadline._called.set()
+
+WATCHDOG = Watchdog()
+
+def getWatchdog():
+    return WATCHDOG
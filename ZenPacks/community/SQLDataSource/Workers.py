@@ -0,0 +1,317 @@
+################################################################################
+#
+# This program is part of the SQLDataSource Zenpack for Zenoss.
+# Copyright (C) 2013 Egor Puzanov.
+#
+# This program can be used under the GNU General Public License version 2
+# You can find full information here: http://www.zenoss.com/oss
+#
+################################################################################
+
+__doc__="""Workers
+
+Child processes of the collector daemon, tasks are sharded between workers
+by consistent hash of the sharding key. Parent and workers exchange length prefixed
+pickled messages, parent writes to worker's stdin and reads from its fd 3.
+
+$Id: Workers.py,v 1.0 2013/04/10 12:00:00 egor Exp $"""
+
+__version__ = "$Revision: 1.0 $"[11:-2]
+
+import logging
+log = logging.getLogger("zen.Workers")
+
+import os
+import sys
+import struct
+import bisect
+import zlib
+import cPickle
+
+from twisted.internet import reactor, defer, protocol
+
+RESPAWN_DELAY = 5
+REPLICAS = 100
+
+
+def packMessage(message):
+    """
+    Returns length prefixed pickled message.
+    """
+    data = cPickle.dumps(message, 2)
+    return struct.pack('!I', len(data)) + data
+
+
+class MessageBuffer(object):
+    """
+    Splits received data to messages and calls handler for every message.
+    """
+
+    def __init__(self, handler):
+        self._handler = handler
+        self._chunks = []
+        self._size = 0
+        self._need = 4
+
+    def feed(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+        # join chunks only when the next message is complete
+        if self._size < self._need: return
+        data = ''.join(self._chunks)
+        offset = 0
+        while len(data) - offset >= 4:
+            size = struct.unpack('!I', data[offset:offset + 4])[0]
+            if len(data) - offset - 4 < size: break
+            message = cPickle.loads(data[offset + 4:offset + 4 + size])
+            offset += 4 + size
+            try:
+                self._handler(message)
+            except Exception:
+                log.exception("Failed to handle message %s", message[0])
+        data = data[offset:]
+        self._chunks = [data]
+        self._size = len(data)
+        self._need = 4
+        if self._size >= 4:
+            self._need += struct.unpack('!I', data[:4])[0]
+
+
+class HashRing(object):
+    """
+    Consistent hash of the keys to the nodes, so only keys of added or
+    removed node change their node.
+    """
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        self._ring = []
+        for node in nodes:
+            for i in range(replicas):
+                self._ring.append((self._hash('%s-%s' % (node, i)), node))
+        self._ring.sort()
+        self._hashes = [h for h, node in self._ring]
+
+    def _hash(self, key):
+        return zlib.crc32(key) & 0xffffffff
+
+    def get(self, key):
+        """
+        Returns node of the key.
+        """
+        if not self._ring:
+            return None
+        i = bisect.bisect(self._hashes, self._hash(key)) % len(self._ring)
+        return self._ring[i][1]
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """
+    Parent side of the worker process connection.
+    """
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self._buffer = MessageBuffer(self._received)
+
+    def _received(self, message):
+        self.pool.received(self.index, message)
+
+    def send(self, message):
+        self.transport.writeToChild(0, packMessage(message))
+
+    def childDataReceived(self, childFD, data):
+        if childFD == 3:
+            self._buffer.feed(data)
+
+    def processEnded(self, reason):
+        self.pool.workerEnded(self, reason)
+
+
+class WorkerPool(object):
+    """
+    Starts worker processes, keeps task configurations of every worker
+    and resends them to restarted worker.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.script = None
+        self.options = {}
+        self.handlers = {}
+        self._workers = []
+        self._ring = HashRing(())
+        self._configs = []
+        self._shards = {}
+        self._generations = {}
+        self._generation = 0
+        self._pending = {}
+        self._stopping = False
+
+    def configure(self, count, script, options, handlers):
+        """
+        @type count: int
+        @param count: number of worker processes
+        @type script: string
+        @param script: path of the script which runs in worker mode with
+            --worker argument
+        @type options: dictionary
+        @param options: options sent to the workers before configurations
+        @type handlers: dictionary
+        @param handlers: message type as a key and handler function
+            handler(index, *args) as a value
+        """
+        self.count = count
+        self.script = script
+        self.options = options
+        self.handlers = handlers
+        self._ring = HashRing(range(count))
+        self._configs = [{} for i in range(count)]
+        self._workers = [None] * count
+
+    def start(self):
+        for index in range(self.count):
+            if self._workers[index] is None:
+                self._spawn(index)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        self._stopping = True
+        for worker in self._workers:
+            if worker is not None and worker.transport is not None:
+                worker.transport.closeStdin()
+
+    def _spawn(self, index):
+        worker = WorkerProcess(self, index)
+        args = [sys.executable, self.script, '--worker']
+        reactor.spawnProcess(worker, sys.executable, args, env=os.environ,
+                            childFDs={0:'w', 1:1, 2:2, 3:'r'})
+        self._workers[index] = worker
+        worker.send(('options', self.options))
+        for message in self._configs[index].values():
+            worker.send(message)
+        log.debug("Worker %s started", index)
+
+    def workerEnded(self, worker, reason):
+        if self._workers[worker.index] is not worker: return
+        self._workers[worker.index] = None
+        for name, index in self._shards.items():
+            if index != worker.index or name not in self._pending: continue
+            for d in self._pending.pop(name):
+                d.errback(reason)
+        if self._stopping: return
+        log.warn("Worker %s ended: %s", worker.index,
+                                        reason.getErrorMessage())
+        reactor.callLater(RESPAWN_DELAY, self._respawn, worker.index)
+
+    def _respawn(self, index):
+        if not self._stopping and self._workers[index] is None:
+            self._spawn(index)
+
+    def send(self, index, message):
+        worker = self._workers[index]
+        if worker is not None:
+            worker.send(message)
+
+    def addTask(self, key, name, *args):
+        """
+        Send task configuration to the worker selected by the key. Returns
+        generation of the task configuration.
+
+        @param key: sharding key (query key)
+        @type key: string
+        @param name: task name
+        @type name: string
+        @rtype: int
+        """
+        index = self._ring.get(key)
+        oldIndex = self._shards.get(name)
+        if oldIndex is not None and oldIndex != index:
+            self.removeTask(name)
+        message = ('config', name) + args
+        self._generation += 1
+        self._generations[name] = self._generation
+        self._shards[name] = index
+        self._configs[index][name] = message
+        self.send(index, message)
+        return self._generation
+
+    def removeTask(self, name, generation=None):
+        """
+        Remove task from the worker, if generation is given only if task
+        was not replaced by the newer configuration.
+        """
+        if generation is not None and \
+            self._generations.get(name) != generation: return
+        self._generations.pop(name, None)
+        index = self._shards.pop(name, None)
+        if index is None: return
+        self._configs[index].pop(name, None)
+        self.send(index, ('cleanup', name))
+
+    def run(self, name):
+        """
+        Run task in the worker, returns deferred which fires when the
+        worker completes the task. Task which is still running is not
+        started again, every caller gets its own deferred.
+        """
+        index = self._shards.get(name)
+        if index is None or self._workers[index] is None:
+            return defer.fail(RuntimeError('Worker of task %s is not '
+                                            'running' % name))
+        d = defer.Deferred()
+        if name in self._pending:
+            self._pending[name].append(d)
+            return d
+        self._pending[name] = [d]
+        self.send(index, ('run', name))
+        return d
+
+    def received(self, index, message):
+        if message[0] == 'done':
+            name, error = message[1:]
+            for d in self._pending.pop(name, ()):
+                if error: d.errback(RuntimeError(error))
+                else: d.callback(None)
+            return
+        handler = self.handlers.get(message[0])
+        if handler is not None:
+            handler(index, *message[1:])
+
+WORKER_POOL = WorkerPool()
+
+def getWorkerPool():
+    return WORKER_POOL
+
+
+class WorkerConnection(protocol.Protocol):
+    """
+    Worker side of the parent process connection, messages are read
+    from stdin and sent to fd 3.
+    """
+
+    def __init__(self, handler):
+        self._buffer = MessageBuffer(handler)
+
+    def dataReceived(self, data):
+        self._buffer.feed(data)
+
+    def send(self, *message):
+        self.transport.write(packMessage(message))
+
+    def connectionLost(self, reason):
+        if reactor.running:
+            reactor.stop()
+
+
+def connectParent(handler):
+    """
+    Connect worker to the parent process.
+
+    @param handler: function called for every message from parent
+    @rtype: WorkerConnection
+    """
+    from twisted.internet import stdio
+    connection = WorkerConnection(handler)
+    stdio.StandardIO(connection, stdin=0, stdout=3)
+    return connection
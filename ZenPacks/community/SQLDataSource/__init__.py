@@ -20,7 +20,18 @@ class ZenPack(ZenPackBase):
     _gdmap = (('Event Queue', 'eventQueueLength', True, '%6.0lf'),
             ('Data Point Rate', 'dataPoints', True, '%5.2lf%s'),
             ('Config Time', 'configTime', False, '%5.2lf%s'),
-            ('Data Points', 'cyclePoints', False, '%5.2lf%s'))
+            ('Data Points', 'cyclePoints', False, '%5.2lf%s'),
+            ('Query Timeouts', 'queryTimeouts', False, '%5.2lf%s'),
+            ('RRD Queue', 'rrdQueueDepth', False, '%5.2lf%s'),
+            ('RRD Queue Full', 'rrdQueueFull', False, '%5.2lf%s'),
+            ('RRD Values Dropped', 'rrdValuesDropped', False, '%5.2lf%s'),
+            ('Events Suppressed', 'eventsSuppressed', False, '%5.2lf%s'),
+            ('Start Load Peak', 'startLoadPeak', False, '%5.2lf%s'),
+            ('Task Overruns', 'taskOverruns', False, '%5.2lf%s'),
+            ('Tasks Skipped', 'tasksSkipped', False, '%5.2lf%s'))
+
+    _derive = ('dataPoints', 'queryTimeouts', 'rrdQueueFull',
+                'rrdValuesDropped', 'eventsSuppressed', 'taskOverruns', 'tasksSkipped')
 
     def install(self, app):
         if not hasattr(app.zport.dmd.Events.Status, 'PyDBAPI'):
@@ -31,7 +42,7 @@ class ZenPack(ZenPackBase):
         ds = pct.manage_addRRDDataSource('zenperfsql', 'BuiltInDS.Built-In')
         for gdn, dpn, stacked, format in self._gdmap:
             dp = ds.manage_addRRDDataPoint(dpn)
-            if dpn in ['dataPoints']:
+            if dpn in self._derive:
                 dp.rrdtype = 'DERIVE'
                 dp.rrdmin = 0
             gd = getattr(pct.graphDefs, gdn, None)
@@ -52,7 +63,7 @@ class ZenPack(ZenPackBase):
         ds = pct.manage_addRRDDataSource('zenperfsql', 'BuiltInDS.Built-In')
         for gdn, dpn, stacked, format in self._gdmap:
             dp = ds.manage_addRRDDataPoint(dpn)
-            if dpn in ['dataPoints']:
+            if dpn in self._derive:
                 dp.rrdtype = 'DERIVE'
                 dp.rrdmin = 0
             gd = getattr(pct.graphDefs, gdn, None)
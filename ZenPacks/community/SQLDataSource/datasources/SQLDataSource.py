@@ -29,6 +29,72 @@ import time
 import os
 import re
 import sys
+from keyword import iskeyword
+
+from ZenPacks.community.SQLDataSource.SQLClient import parseArguments
+
+SKIP_TOKENS = ('LIMIT', 'OR', 'NOT', 'HAVING', 'PROCEDURE','INTO')
+WHERE_END_TOKENS = ('GROUP BY', 'ORDER BY', 'GO', ';')
+
+def _rePrepare(tokens):
+    return '[ \\n]%s[ \\n]'%'[ \\n]|[ \\n]'.join(tokens)
+
+SKIPPAT = re.compile(_rePrepare(SKIP_TOKENS))
+WHEREENDPAT = re.compile(_rePrepare(WHERE_END_TOKENS))
+ANDPAT = re.compile(' AND ', re.I)
+QUERY_CACHE = {}
+QUERY_CACHE_SIZE = 10000
+FROMPAT_CACHE = {}
+
+def _fromPattern(aliases):
+    """
+    Returns compiled pattern of the FROM clause after the data point columns.
+    """
+    pattern = FROMPAT_CACHE.get(aliases)
+    if pattern is None:
+        pattern = FROMPAT_CACHE[aliases] = re.compile(
+                        '[%s]\]?(\s+)FROM\s'%'|'.join(aliases), re.I)
+    return pattern
+
+def _parseKeybindings(where):
+    """
+    Parse "column='value',column2=1" keybindings without eval.
+    """
+    args, kbs = parseArguments(where)
+    if args or [k for k in kbs if iskeyword(k)]:
+        raise ValueError("Invalid keybindings: %s"%where)
+    return kbs
+
+def parseSqlQuery(sql, aliases):
+    """
+    Split WHERE clause of the query in to the keybindings and query without
+    WHERE clause with keybinding columns added to the columns list.
+
+    @param sql: sql query
+    @type sql: string
+    @param aliases: column names of the data points
+    @type aliases: tuple
+    @return: query and keybindings
+    @rtype: tuple
+    """
+    sql_u = sql.upper()
+    where_s = sql_u.rfind('WHERE ') + 6
+    if where_s < 6: return sql, {}
+    if SKIPPAT.search(sql_u[where_s:]): return sql, {}
+    where_e = WHEREENDPAT.search(sql_u[where_s:])
+    if where_e: where_e = where_e.start() + where_s
+    else: where_e = len(sql)
+    try:
+        where = ANDPAT.sub(',', sql[where_s:where_e].encode('unicode-escape'))
+        kbs = _parseKeybindings(where)
+        FROMPAT = _fromPattern(aliases)
+        sql = sql[:where_s - 6] + sql[where_e:]
+        newCols=[k for k in kbs.keys() if k.upper() not in sql_u[:where_s]]
+        if newCols and '*' not in sql[:where_s]:
+            sql = re.sub(FROMPAT, lambda m: m.group(0).replace(m.group(1),
+                        ',' + ','.join(kbs.keys()) + m.group(1), 1), sql)
+    except: return sql, {}
+    return sql.strip(), kbs
 
 class SQLDataSource(ZenPackPersistence, RRDDataSource):
 
@@ -90,33 +156,19 @@ class SQLDataSource(ZenPackPersistence, RRDDataSource):
 
 
     def rePrepare(self, tokens):
-        return '[ \\n]%s[ \\n]'%'[ \\n]|[ \\n]'.join(tokens)
+        return _rePrepare(tokens)
 
 
     def parseSqlQuery(self, sql):
-        skip_tokens = ('LIMIT', 'OR', 'NOT', 'HAVING', 'PROCEDURE','INTO')
-        where_end_tokens = ('GROUP BY', 'ORDER BY', 'GO', ';')
-        sql_u = sql.upper()
-        where_s = sql_u.rfind('WHERE ') + 6
-        if where_s < 6: return sql, {}
-        if re.search(self.rePrepare(skip_tokens),sql_u[where_s:]):return sql,{}
-        where_e = re.search(self.rePrepare(where_end_tokens),sql_u[where_s:])
-        if where_e: where_e = where_e.start() + where_s
-        else: where_e = len(sql)
-        try:
-            where = re.compile(' AND ', re.I).sub(',',
-                                sql[where_s:where_e].encode('unicode-escape'))
-            kbs = eval('(lambda **kws:kws)(%s)'%where)
-            FROMPAT = re.compile('[%s]\]?(\s+)FROM\s'%'|'.join(
-                                    [(dp.getAliasNames() or [dp.id])[0] \
-                                    for dp in self.getRRDDataPoints()]), re.I)
-            sql = sql[:where_s - 6] + sql[where_e:]
-            newCols=[k for k in kbs.keys() if k.upper() not in sql_u[:where_s]]
-            if newCols and '*' not in sql[:where_s]:
-                sql = re.sub(FROMPAT, lambda m: m.group(0).replace(m.group(1),
-                            ',' + ','.join(kbs.keys()) + m.group(1), 1), sql)
-        except: return sql, {}
-        return sql.strip(), kbs
+        aliases = tuple([(dp.getAliasNames() or [dp.id])[0] \
+                        for dp in self.getRRDDataPoints()])
+        key = (sql, aliases)
+        result = QUERY_CACHE.get(key)
+        if result is None:
+            if len(QUERY_CACHE) >= QUERY_CACHE_SIZE:
+                QUERY_CACHE.clear()
+            result = QUERY_CACHE[key] = parseSqlQuery(sql, aliases)
+        return result[0], dict(result[1])
 
 
     def getConnectionString(self, context):
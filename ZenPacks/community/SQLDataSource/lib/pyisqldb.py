@@ -29,6 +29,10 @@ import subprocess
 import os
 import signal
 import re
+try:
+    from ZenPacks.community.SQLDataSource.Watchdog import getWatchdog
+except:
+    getWatchdog = None
 DTPAT = re.compile(r'^(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})')
 
 class DBAPITypeObject:
@@ -157,6 +161,7 @@ class isqlCursor(object):
         self.rownumber = -1
         self.arraysize = 1
         self._description = None
+        self._process = None
         self._rows = []
         self._queue = []
 
@@ -206,15 +211,22 @@ class isqlCursor(object):
                                 stdin=subprocess.PIPE,
                                 stderr=subprocess.PIPE,
                                 stdout=subprocess.PIPE)
+            self._process = p
             queries = [q.strip().replace('\n',' ') for q in self._queue]
             del self._queue[:]
-            t = threading.Timer(self._timeout, os.kill, [p.pid, signal.SIGTERM])
-            t.start()
+            if getWatchdog:
+                t = getWatchdog().schedule(self._timeout, os.kill, p.pid,
+                                                            signal.SIGTERM)
+            else:
+                t = threading.Timer(self._timeout, os.kill,
+                                                    [p.pid, signal.SIGTERM])
+                t.start()
             try:
                 lines, err = p.communicate('%s\n'%'\n'.join(queries))
             except Exception, e:
                 err = t.isAlive() and str(e) or 'Operation timed out'
             t.cancel()
+            self._process = None
             if err: raise OperationalError(err.strip())
             for line in lines.splitlines():
                 if line.startswith('[ISQL]INFO:'): pass
@@ -284,6 +296,15 @@ class isqlCursor(object):
             operation = operation%args[0]
         self._queue.append(operation)
 
+    def cancel(self):
+        """
+        Cancel the operation currently running in other thread.
+        """
+        p = self._process
+        if p is None: return
+        try: os.kill(p.pid, signal.SIGTERM)
+        except OSError: pass
+
     def executemany(self, operation, param_seq):
         """
         Execute a database operation repeatedly for each element in the
@@ -314,21 +335,18 @@ class isqlCursor(object):
         """Fetch up to size rows from the cursor. Result set may be smaller
         than size. If size is not defined, cursor.arraysize is used."""
         self._check_executed()
-        if size: size += self.rownumber
-        else: size = self.arraysize + self.rownumber
-        results = []
-        while self._rows and self.rownumber < size:
-            self.rownumber += 1
-            results.append(self._rows.pop(0))
+        if not size: size = self.arraysize
+        results = self._rows[:size]
+        del self._rows[:size]
+        self.rownumber += len(results)
         return results
 
     def fetchall(self):
         """Fetchs all available rows from the cursor."""
         self._check_executed()
-        results = []
-        while self._rows:
-            self.rownumber += 1
-            results.append(self._rows.pop(0))
+        results = self._rows[:]
+        del self._rows[:]
+        self.rownumber += len(results)
         return results
 
     def next(self):
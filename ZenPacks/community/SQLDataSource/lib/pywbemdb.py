@@ -530,6 +530,13 @@ class wbemCursor(object):
         except Exception, e:
             raise OperationalError(e)
 
+    def cancel(self):
+        """
+        Cancel the operation currently running in other thread.
+        """
+        if self._connection:
+            self._connection._cancel()
+
     def executemany(self, operation, param_seq):
         """
         Execute a database operation repeatedly for each element in the
@@ -560,21 +567,18 @@ class wbemCursor(object):
         """Fetch up to size rows from the cursor. Result set may be smaller
         than size. If size is not defined, cursor.arraysize is used."""
         self._check_executed()
-        if size: size += self.rownumber
-        else: size = self.arraysize + self.rownumber
-        results = []
-        while self._rows and self.rownumber < size:
-            self.rownumber += 1
-            results.append(self._rows.pop(0))
+        if not size: size = self.arraysize
+        results = self._rows[:size]
+        del self._rows[:size]
+        self.rownumber += len(results)
         return results
 
     def fetchall(self):
         """Fetchs all available rows from the cursor."""
         self._check_executed()
-        results = []
-        while self._rows:
-            self.rownumber += 1
-            results.append(self._rows.pop(0))
+        results = self._rows[:]
+        del self._rows[:]
+        self.rownumber += len(results)
         return results
 
     def next(self):
@@ -687,6 +691,17 @@ class pywbemCnx:
                 socket.setdefaulttimeout(oldtimeout)
             self._lock.release()
 
+    def _cancel(self):
+        """
+        Shutdown the socket of currently running HTTP request, the request
+        fails immediately with socket error.
+        """
+        connection = self._connection
+        sock = getattr(connection, 'sock', None)
+        if sock is None: return
+        try: sock.shutdown(socket.SHUT_RDWR)
+        except Exception: pass
+
     def __del__(self):
         self.close()
 
@@ -367,21 +367,18 @@ class wmiCursor(object):
         """Fetch up to size rows from the cursor. Result set may be smaller
         than size. If size is not defined, cursor.arraysize is used."""
         self._check_executed()
-        if size: size += self.rownumber
-        else: size = self.arraysize + self.rownumber
-        results = []
-        while self._rows and self.rownumber < size:
-            self.rownumber += 1
-            results.append(self._rows.pop(0))
+        if not size: size = self.arraysize
+        results = self._rows[:size]
+        del self._rows[:size]
+        self.rownumber += len(results)
         return results
 
     def fetchall(self):
         """Fetchs all available rows from the cursor."""
         self._check_executed()
-        results = []
-        while self._rows:
-            self.rownumber += 1
-            results.append(self._rows.pop(0))
+        results = self._rows[:]
+        del self._rows[:]
+        self.rownumber += len(results)
         return results
 
     def next(self):
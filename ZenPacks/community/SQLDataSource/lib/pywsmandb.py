@@ -620,6 +620,13 @@ class wsmanCursor(object):
         except Exception, e:
             raise OperationalError(e)
 
+    def cancel(self):
+        """
+        Cancel the operation currently running in other thread.
+        """
+        if self._connection:
+            self._connection._cancel()
+
     def executemany(self, operation, param_seq):
         """
         Execute a database operation repeatedly for each element in the
@@ -821,6 +828,17 @@ class wsmanCnx:
                 socket.setdefaulttimeout(oldtimeout)
             self._lock.release()
 
+    def _cancel(self):
+        """
+        Shutdown the socket of currently running HTTP request, the request
+        fails immediately with socket error.
+        """
+        connection = self._connection
+        sock = getattr(connection, 'sock', None)
+        if sock is None: return
+        try: sock.shutdown(socket.SHUT_RDWR)
+        except Exception: pass
+
     def __del__(self):
         self.close()
 
@@ -42,6 +42,48 @@ class SqlPerformanceConfig(CollectorConfigService):
         CollectorConfigService.__init__(self, dmd, instance)
         self.evtOrgNames = dmd.Events.Status.getOrganizerNames()
 
+    # template level artifacts cache, exists while device proxy is created
+    _templateCache = None
+
+    def _cached(self, key, factory, *args):
+        """
+        Returns template level value, computed once per device proxy.
+        """
+        cache = self._templateCache
+        if cache is None:
+            return factory(*args)
+        if key not in cache:
+            cache[key] = factory(*args)
+        return cache[key]
+
+    def _getDatapointsInfo(self, ds, perfServer):
+        """
+        Returns component independent data points parameters
+        """
+        info = []
+        for dp in ds.getRRDDataPoints():
+            aliases = [(alias.id.strip().lower(),
+                        getattr(alias, 'formula', None)) \
+                        for alias in dp.aliases()]
+            info.append((dp.id, dp.name(), aliases, dp.rrdtype,
+                        dp.getRRDCreateCommand(perfServer),
+                        dp.rrdmin, dp.rrdmax))
+        return info
+
+    def _resolveAlias(self, dpId, aliases, sql):
+        """
+        Returns column name and formula of the data point
+        """
+        alias, formula = '', None
+        for aliasId, aliasFormula in aliases:
+            if alias and ' %s '%aliasId not in sql: continue
+            alias = aliasId
+            if aliasFormula:
+                formula = aliasFormula
+        if not alias:
+            alias = dpId.strip().lower()
+        return alias, formula
+
     def _getDsDatapoints(self, comp, ds, perfServer, dpnames, sql=''):
         """
         Given a component a data source, gather its data points
@@ -54,28 +96,36 @@ class SqlPerformanceConfig(CollectorConfigService):
         else:
             component_name = getattr(comp, 'id', '')
         basepath = comp.rrdPath()
-        for dp in ds.getRRDDataPoints():
-            dpnames.add(dp.name())
+        dsPath = ds.getPrimaryId()
+        for dpId, dpName, aliases, rrdType, rrdCreateSql, rrdMin, rrdMax in \
+            self._cached(('datapoints', dsPath), self._getDatapointsInfo,
+                                                            ds, perfServer):
+            dpnames.add(dpName)
             dpc = DataPointConfig()
-            dpc.id = dp.id
-            for alias in dp.aliases():
-                aliasId = alias.id.strip().lower()
-                if dpc.alias and ' %s '%aliasId not in sql: continue
-                dpc.alias = aliasId
-                formula = getattr(alias, 'formula', None)
-                if not formula: continue
+            dpc.id = dpId
+            dpc.alias, formula = self._cached(('alias', dsPath, dpId, sql),
+                                        self._resolveAlias, dpId, aliases, sql)
+            if formula and '$' in formula:
                 dpc.expr=talesEval("string:%s"%formula,comp,extra={'now':'now'})
-            if not dpc.alias:
-                dpc.alias = dp.id.strip().lower()
+            elif formula:
+                dpc.expr = formula
             dpc.component = component_name
-            dpc.rrdPath = "/".join((basepath, dp.name()))
-            dpc.rrdType = dp.rrdtype
-            dpc.rrdCreateSql = dp.getRRDCreateCommand(perfServer)
-            dpc.rrdMin = dp.rrdmin
-            dpc.rrdMax = dp.rrdmax
+            dpc.rrdPath = "/".join((basepath, dpName))
+            dpc.rrdType = rrdType
+            dpc.rrdCreateSql = rrdCreateSql
+            dpc.rrdMin = rrdMin
+            dpc.rrdMax = rrdMax
             points.append(dpc)
         return points
 
+    def _getTemplateDatasources(self, templ):
+        return [ds for ds in templ.getRRDDataSources() \
+                if isinstance(ds, DataSource) and ds.enabled]
+
+    def _getTemplateThresholds(self, templ):
+        return [(threshold, set(threshold.dsnames)) \
+                for threshold in templ.thresholds() if threshold.enabled]
+
     def _getDsCycleTime(self, comp, templ, ds):
         cycleTime = 300
         try:
@@ -126,8 +176,9 @@ class SqlPerformanceConfig(CollectorConfigService):
             eventClass = 'PyDBAPI'
         for templ in comp.getRRDTemplates():
             dpnames = set()
-            for ds in templ.getRRDDataSources():
-                if not (isinstance(ds, DataSource) and ds.enabled): continue
+            templPath = templ.getPrimaryId()
+            for ds in self._cached(('datasources', templPath),
+                                    self._getTemplateDatasources, templ):
                 query = DataSourceConfig()
                 query.name = "%s/%s" % (templ.id, ds.id)
                 query.cycleTime = self._getDsCycleTime(comp, templ, ds)
@@ -169,8 +220,9 @@ class SqlPerformanceConfig(CollectorConfigService):
                 self.enrich(query, templ, ds)
                 queries.add(query)
 
-            for threshold in templ.thresholds():
-                if threshold.enabled and dpnames & set(threshold.dsnames):
+            for threshold, dsnames in self._cached(('thresholds', templPath),
+                                        self._getTemplateThresholds, templ):
+                if dpnames & dsnames:
                     thresholds.append(threshold.createThresholdInstance(comp))
 
         return thresholds
@@ -193,15 +245,19 @@ class SqlPerformanceConfig(CollectorConfigService):
         perfServer = device.getPerformanceServer()
         datasources = set()
 
-        # First for the device....
-        proxy.thresholds = []
-        self._safeGetComponentConfig(device, device, perfServer,
-                                datasources, proxy.thresholds)
+        self._templateCache = {}
+        try:
+            # First for the device....
+            proxy.thresholds = []
+            self._safeGetComponentConfig(device, device, perfServer,
+                                    datasources, proxy.thresholds)
 
-        # And now for its components
-        for comp in device.getMonitoredComponents():
-            self._safeGetComponentConfig(comp, device, perfServer,
-                                datasources, proxy.thresholds)
+            # And now for its components
+            for comp in device.getMonitoredComponents():
+                self._safeGetComponentConfig(comp, device, perfServer,
+                                    datasources, proxy.thresholds)
+        finally:
+            self._templateCache = None
 
         if datasources:
             proxy.datasources = list(datasources)
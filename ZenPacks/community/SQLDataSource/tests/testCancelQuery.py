@@ -0,0 +1,122 @@
+################################################################################
+#
+# This program is part of the SQLDataSource Zenpack for Zenoss.
+# Copyright (C) 2013 Egor Puzanov.
+#
+# This program can be used under the GNU General Public License version 2
+# You can find full information here: http://www.zenoss.com/oss
+#
+################################################################################
+
+__doc__="""testCancelQuery
+
+Query timeouts and cancellation checked with sqlite3 interrupt().
+
+$Id: testCancelQuery.py,v 1.0 2013/04/20 12:00:00 egor Exp $"""
+
+__version__ = "$Revision: 1.0 $"[11:-2]
+
+import sqlite3
+import threading
+import time
+import unittest
+
+from ZenPacks.community.SQLDataSource import SQLClient
+from ZenPacks.community.SQLDataSource.SQLClient import adbapiClient, \
+                                                        TimeoutError
+
+SLOW_QUERY = 'SELECT count(*) AS c FROM t a, t b, t c'
+FAST_QUERY = 'SELECT count(*) AS c FROM t'
+
+
+class FakePool(object):
+    dbapiName = 'sqlite3'
+
+
+class FakeConnection(object):
+
+    def __init__(self, connection):
+        self._connection = connection
+
+
+class FakeTransaction(object):
+    """
+    Cursor wrapper with the attributes of adbapi.Transaction used by
+    cancelQuery.
+    """
+
+    def __init__(self, connection):
+        self._pool = FakePool()
+        self._connection = FakeConnection(connection)
+        self._cursor = connection.cursor()
+        self.reconnected = False
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def reconnect(self):
+        self.reconnected = True
+
+
+class TestCancelQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = sqlite3.connect(':memory:',
+                                          check_same_thread=False)
+        self.connection.execute('CREATE TABLE t (x INTEGER)')
+        self.connection.executemany('INSERT INTO t VALUES (?)',
+                                    [(i,) for i in range(1000)])
+        self.client = adbapiClient("'sqlite3',':memory:'")
+        self.canceller = SQLClient.CANCELLERS['sqlite3']
+        self.cancelTimeout = SQLClient.CANCEL_TIMEOUT
+
+    def tearDown(self):
+        SQLClient.CANCELLERS['sqlite3'] = self.canceller
+        SQLClient.CANCEL_TIMEOUT = self.cancelTimeout
+        self.connection.close()
+
+    def runQuery(self, txn, sql, timeout):
+        return self.client.runQuery(txn, sql, ['c'], timeout)
+
+    def testInterrupt(self):
+        txn = FakeTransaction(self.connection)
+        started = time.time()
+        self.assertRaises(TimeoutError, self.runQuery, txn, SLOW_QUERY, 0.2)
+        self.assert_(time.time() - started < 5)
+        self.assertFalse(txn.reconnected)
+        result = self.runQuery(FakeTransaction(self.connection),
+                                                            FAST_QUERY, 5)
+        self.assertEqual(result.rows, [(1000,)])
+
+    def testCompletedAfterDeadline(self):
+        cancelled = []
+        def slowCanceller(cursor, connection, pool):
+            def cancel():
+                time.sleep(0.5)
+                cancelled.append(time.time())
+            return SQLClient._callInThread(cancel)
+        SQLClient.CANCELLERS['sqlite3'] = slowCanceller
+        txn = FakeTransaction(self.connection)
+        self.assertRaises(TimeoutError, self.runQuery, txn,
+                            'SELECT count(*) AS c FROM t a, t b', 0.001)
+        # the connection is returned only after cancellation completed
+        self.assertEqual(len(cancelled), 1)
+        self.assert_(cancelled[0] <= time.time())
+        self.assertFalse(txn.reconnected)
+
+    def testReconnectIfCancellationHangs(self):
+        def hangingCanceller(cursor, connection, pool):
+            connection.interrupt()
+            return threading.Event()
+        SQLClient.CANCELLERS['sqlite3'] = hangingCanceller
+        SQLClient.CANCEL_TIMEOUT = 0.5
+        txn = FakeTransaction(self.connection)
+        self.assertRaises(TimeoutError, self.runQuery, txn, SLOW_QUERY, 0.2)
+        self.assert_(txn.reconnected)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestCancelQuery))
+    return suite
@@ -16,22 +16,29 @@ $Id: zenperfsql.py,v 3.16 2013/03/22 18:47:29 egor Exp $"""
 
 __version__ = "$Revision: 3.16 $"[11:-2]
 
+import os
+import sys
 import time
+import zlib
+import threading
+import Queue
+import cPickle
 from datetime import datetime, timedelta
 import logging
 log = logging.getLogger("zen.zenperfsql")
 from copy import copy
+from optparse import Values
 
-from twisted.internet import reactor, defer, error
+from twisted.internet import reactor, defer, error, threads
 from twisted.python.failure import Failure
 
 import Globals
 import zope.interface
 
 from Products.ZenModel.ZVersion import VERSION as ZVERSION
-from Products.ZenUtils.Utils import unused
+from Products.ZenUtils.Utils import unused, zenPath
 from Products.ZenUtils.observable import ObservableMixin
-from Products.ZenEvents.ZenEventClasses import Clear, Error
+from Products.ZenEvents.ZenEventClasses import Clear, Error, Warning
 from Products.ZenRRD.CommandParser import ParsedResults
 
 from Products.ZenCollector.daemon import CollectorDaemon
@@ -43,10 +50,30 @@ from Products.ZenCollector.interfaces import ICollectorPreferences,\
 from Products.ZenCollector.tasks import SimpleTaskFactory,\
                                         SimpleTaskSplitter,\
                                         TaskStates
+try:
+    from Products.ZenCollector.interfaces import IStatisticsService
+except ImportError:
+    IStatisticsService = None
 from ZenPacks.community.SQLDataSource.SQLClient import  adbapiClient, \
                                                         DataSourceConfig, \
                                                         DataPointConfig, \
-                                                        getConnection
+                                                        getConnection, \
+                                                        getPoolManager, \
+                                                        getQueryLimiter, \
+                                                        releaseConnection, \
+                                                        splitKeybindings, \
+                                                        rowKey, \
+                                                        connectionKey, \
+                                                        ResultSet, \
+                                                        TimeoutError, \
+                                                        IDLE_TIMEOUT, \
+                                                        PING_INTERVAL, \
+                                                        MAX_QUERIES, \
+                                                        FETCH_MIN, \
+                                                        FETCH_MAX
+from ZenPacks.community.SQLDataSource.Watchdog import getWatchdog
+from ZenPacks.community.SQLDataSource.Workers import getWorkerPool, \
+                                                     connectParent
 from Products.ZenEvents import Event
 
 from Products.DataCollector import Plugins
@@ -60,6 +87,15 @@ unused(DeviceProxy)
 
 COLLECTOR_NAME = "zenperfsql"
 POOL_NAME = 'SqlConfigs'
+RRD_QUEUE_SIZE = 10000
+EVENT_RESYNC_INTERVAL = 3600
+OVERRUN_LIMIT = 2
+MAX_SKIP = 32
+DURATION_HISTORY = 10
+SNAPSHOT_VERSION = 1
+SNAPSHOT_DELAY = 60
+RRD_BUFFER_SIZE = 100000
+SHARED_RESULT_TTL = 10
 
 #
 # RPN reverse calculation
@@ -74,25 +110,724 @@ OPERATORS = {
 }
 
 
+EXPR_CACHE = {}
+EXPR_CACHE_SIZE = 10000
+
+def compileRPN(expression):
+    """
+    Parse reverse RPN expression once, returns function(value, now).
+    """
+    program = []
+    for token in reversed(expression.split(',')):
+        if token == 'now':
+            program.append(('now', None))
+            continue
+        try:
+            program.append(('num', float(token)))
+        except ValueError:
+            program.append(('op', token))
+    def rrpn(value, now):
+        oper = None
+        try:
+            stack = [float(value)]
+            for kind, token in program:
+                if kind == 'num':
+                    stack.append(token)
+                elif kind == 'now':
+                    stack.append(now)
+                else:
+                    if oper:
+                        stack.append(OPERATORS[oper](stack.pop(-2),stack.pop()))
+                    oper = token
+            val = OPERATORS[oper](stack.pop(-2), stack.pop())
+            return val//1
+        except:
+            return value
+    return rrpn
+
 def rrpn(expression, value):
-    oper = None
+    """
+    Deprecated, use compileExpression(expression)(value, now).
+    """
+    return compileRPN(expression)(value, time.time())
+
+def compileMap(expression):
+    """
+    Evaluate dictionary expression once, returns function(value, now).
+    """
     try:
-        stack = [float(value)]
-        tokens = expression.split(',')
-        tokens.reverse()
-        for token in tokens:
-            if token == 'now':
-                token = time.time()
+        ed = eval('{%s}'%expression.lower())
+    except Exception, ex:
+        log.warning("Invalid data point expression %s: %s", expression, ex)
+        def invalid(value, now):
+            raise ValueError(expression)
+        return invalid
+    unknown = ed.get('unknown')
+    def mapValue(value, now):
+        if isinstance(value, float):
+            value = int(value)
+        return ed.get(str(value).lower()) or unknown
+    return mapValue
+
+def compileExpression(expression):
+    """
+    Returns cached function(value, now) for data point expression or None.
+
+    @param expression: dictionary items or reverse RPN
+    @type expression: string
+    """
+    if not expression:
+        return None
+    func = EXPR_CACHE.get(expression)
+    if func is None:
+        if ':' in expression:
+            func = compileMap(expression)
+        else:
+            func = compileRPN(expression)
+        if len(EXPR_CACHE) >= EXPR_CACHE_SIZE:
+            EXPR_CACHE.clear()
+        EXPR_CACHE[expression] = func
+    return func
+
+
+def setStatistic(name, value, type='GAUGE'):
+    """
+    Set the value of daemon statistic, CollectorDaemon posts it to the
+    zenperfsql_<name> data point of the collector.
+    """
+    if IStatisticsService is None:
+        return
+    statService = zope.component.queryUtility(IStatisticsService)
+    if statService is None:
+        return
+    try:
+        stat = statService.getStatistic(name)
+    except KeyError:
+        statService.addStatistic(name, type)
+        stat = statService.getStatistic(name)
+    stat.value = value
+
+
+def percentile(values, percent):
+    """
+    Returns percentile of the values with linear interpolation between
+    the closest ranks.
+
+    @parameter values: list of the values
+    @type values: list
+    @parameter percent: percentile in range 0 - 100
+    @type percent: float
+    """
+    values = sorted(values)
+    k = (len(values) - 1) * percent / 100.0
+    f = int(k)
+    if f + 1 >= len(values):
+        return values[f]
+    return values[f] + (values[f + 1] - values[f]) * (k - f)
+
+
+class RRDWriter(object):
+    """
+    Writes RRD values in a dedicated thread. Every task run puts single
+    batch of writeRRD arguments in to the bounded queue, writer thread
+    drains all queued batches and writes only the latest value of every
+    RRD file. If queue is full, values of the batch are kept in overflow
+    map with the latest value of every RRD file, so the reactor never
+    waits for the writer. Values replaced by newer values before they
+    were written are counted as dropped. The writer thread is the only
+    thread which writes RRD files of the collected values, thresholds are
+    checked in the reactor thread.
+    """
+
+    def __init__(self, queueSize=RRD_QUEUE_SIZE):
+        """
+        @type queueSize: int
+        @param queueSize: max number of queued batches, 0 - synchronous
+        """
+        self.queueSize = queueSize
+        self.full = 0
+        self.dropped = 0
+        self._dataService = None
+        self._queue = None
+        self._thread = None
+        self._stopped = False
+        self._seq = 0
+        self._overflow = {}
+        self._lock = threading.Lock()
+
+    def configure(self, queueSize=None):
+        if queueSize is not None:
+            self.queueSize = max(queueSize, 0)
+
+    def start(self, dataService):
+        """
+        Start writer thread.
+        """
+        self._dataService = dataService
+        if self._thread is not None or self.queueSize < 1: return
+        self._queue = Queue.Queue(self.queueSize)
+        self._thread = threading.Thread(target=self._run, name='RRDWriter')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        """
+        Wait until queued values are written.
+        """
+        if self._thread is None: return
+        thread, self._thread = self._thread, None
+        self._stopped = True
+        try:
+            self._queue.put_nowait(None)
+        except Queue.Full:
+            pass
+        thread.join(30)
+
+    @property
+    def depth(self):
+        return self._queue is not None and self._queue.qsize() or 0
+
+    def put(self, dataService, batch):
+        """
+        Queue list of writeRRD arguments.
+
+        @type dataService: IDataService
+        @param batch: list of writeRRD arguments
+        @type batch: list
+        """
+        if not batch: return
+        if self._dataService is None:
+            self.start(dataService)
+        if self._thread is None:
+            self._writeRRD(batch)
+            return
+        self._seq += 1
+        try:
+            self._queue.put_nowait((self._seq, batch))
+            return
+        except Queue.Full:
+            self.full += 1
+        self._lock.acquire()
+        try:
+            for args in batch:
+                if args[0] in self._overflow: self.dropped += 1
+                self._overflow[args[0]] = (self._seq, args)
+        finally:
+            self._lock.release()
+
+    def _writeRRD(self, batch):
+        """
+        Write values and check thresholds with dataService.writeRRD.
+        """
+        writeRRD = self._dataService.writeRRD
+        for args in batch:
+            try:
+                writeRRD(*args)
+            except Exception:
+                log.exception("Failed to write RRD %s", args[0])
+
+    def _write(self, batch):
+        """
+        Write RRD files in the writer thread, the same way as
+        CollectorDaemon.writeRRD does, and check thresholds of the written
+        values in the reactor thread.
+        """
+        if not hasattr(self._dataService, '_thresholds'):
+            # not a CollectorDaemon, writeRRD must be called in the reactor
+            reactor.callFromThread(self._writeRRD, batch)
+            return
+        # collector RRD is configured after preferences are loaded
+        while getattr(self._dataService, '_rrd', None) is None:
+            if self._stopped: return
+            time.sleep(1)
+        rrd = self._dataService._rrd
+        checks = []
+        for args in batch:
+            path, value, rrdType, rrdCommand, cycleTime, rrdMin, rrdMax = \
+                                                                    args[:7]
+            now = time.time()
+            try:
+                value = rrd.save(path, value, rrdType, rrdCommand, cycleTime,
+                                                            rrdMin, rrdMax)
+            except Exception:
+                log.exception("Failed to write RRD %s", path)
+                continue
+            checks.append((path, now, value, len(args) > 7 and args[7] or {}))
+        if checks:
+            reactor.callFromThread(self._checkThresholds, checks)
+
+    def _checkThresholds(self, checks):
+        thresholds = self._dataService._thresholds
+        sendEvent = self._dataService.sendEvent
+        for path, now, value, threshEventData in checks:
+            try:
+                if 'eventKey' in threshEventData:
+                    eventKeyPrefix = [threshEventData['eventKey']]
+                else:
+                    eventKeyPrefix = [path.rsplit('/')[-1]]
+                for ev in thresholds.check(path, now, value):
+                    parts = eventKeyPrefix[:]
+                    if 'eventKey' in ev:
+                        parts.append(ev['eventKey'])
+                    ev['eventKey'] = '|'.join(parts)
+                    ev.update(threshEventData)
+                    sendEvent(ev)
+            except Exception:
+                log.exception("Failed to check thresholds of %s", path)
+
+    def _run(self):
+        queue = self._queue
+        reported = 0
+        while True:
+            items = [queue.get()]
+            try:
+                while True:
+                    items.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+            self._lock.acquire()
             try:
-                stack.append(float(token))
-            except ValueError:
-                if oper:
-                    stack.append(OPERATORS[oper](stack.pop(-2), stack.pop()))
-                oper = token
-        val = OPERATORS[oper](stack.pop(-2), stack.pop())
-        return val//1
-    except:
-        return value
+                overflow, self._overflow = self._overflow, {}
+            finally:
+                self._lock.release()
+            # merge by sequence number, the latest put value wins
+            latest = {}
+            paths = []
+            for item in items:
+                if item is None: continue
+                seq, batch = item
+                for args in batch:
+                    path = args[0]
+                    if path not in latest: paths.append(path)
+                    elif latest[path][0] <= seq: self.dropped += 1
+                    else:
+                        self.dropped += 1
+                        continue
+                    latest[path] = (seq, args)
+            for path, (seq, args) in overflow.items():
+                if path not in latest: paths.append(path)
+                else:
+                    self.dropped += 1
+                    if latest[path][0] > seq: continue
+                latest[path] = (seq, args)
+            self._write([latest[path][1] for path in paths])
+            if self.dropped > reported:
+                log.warn("RRD writer is behind, %s values were replaced by "
+                        "newer values before written", self.dropped - reported)
+                reported = self.dropped
+            if None in items or self._stopped:
+                return
+
+RRD_WRITER = RRDWriter()
+
+def getRRDWriter():
+    return RRD_WRITER
+
+
+class EventStateCache(object):
+    """
+    Last sent state of the events by device, component, eventClass and
+    eventKey. Event which doesn't change the state is sent again only
+    after resyncInterval seconds.
+    """
+
+    def __init__(self, resyncInterval=EVENT_RESYNC_INTERVAL):
+        """
+        @type resyncInterval: int
+        @param resyncInterval: seconds before unchanged event will be sent
+            again, 0 - send all events
+        """
+        self.resyncInterval = resyncInterval
+        self.suppressed = 0
+        self._states = {}
+
+    def configure(self, resyncInterval=None):
+        if resyncInterval is not None:
+            self.resyncInterval = resyncInterval
+
+    def _key(self, event):
+        return (event.get('device'), event.get('component', ''),
+                event.get('eventClass', ''), event.get('eventKey', ''))
+
+    def forget(self, event):
+        """
+        Forget the last sent state of the event, so the next event with
+        the same key is sent whatever state it has.
+
+        @param event: event fields
+        @type event: dictionary
+        """
+        self._states.pop(self._key(event), None)
+
+    def changed(self, event):
+        """
+        Returns True if the event must be sent and remembers its state.
+
+        @param event: event fields
+        @type event: dictionary
+        """
+        key = self._key(event)
+        state = (event.get('severity'), event.get('summary'))
+        now = time.time()
+        last = self._states.get(key)
+        if self.resyncInterval > 0 and last is not None and \
+            last[0] == state and now - last[1] < self.resyncInterval:
+            self.suppressed += 1
+            return False
+        self._states[key] = (state, now)
+        return True
+
+EVENT_STATE = EventStateCache()
+
+def getEventState():
+    return EVENT_STATE
+
+
+class SharedQueries(object):
+    """
+    Runs the same query of the tasks from different devices only once, if
+    tasks run it at the same time. Tasks are counted by connection string,
+    query, columns and interval; if more than one task subscribed, the
+    first task runs the query and the other tasks wait for its results.
+    Results are kept until every subscribed task got them, but not longer
+    than ttl seconds (at most half of the interval) after the query
+    completed, expired results are deleted by the reactor.
+    """
+
+    def __init__(self, ttl=SHARED_RESULT_TTL):
+        """
+        @type ttl: int
+        @param ttl: seconds to keep completed results, 0 - share only
+            running queries
+        """
+        self.ttl = ttl
+        self._subscribers = {}
+        self._results = {}
+
+    def subscribe(self, key):
+        self._subscribers[key] = self._subscribers.get(key, 0) + 1
+
+    def unsubscribe(self, key):
+        count = self._subscribers.get(key, 0) - 1
+        if count > 0:
+            self._subscribers[key] = count
+            return
+        self._subscribers.pop(key, None)
+        entry = self._results.get(key)
+        if entry is not None:
+            self._expire(key, entry)
+
+    def query(self, key, connection, datasource, consumer, interval):
+        """
+        Execute query or wait for results of the same query.
+
+        @param key: query key
+        @type key: tuple
+        @param connection: database connection
+        @type connection: adbapiClient
+        @param datasource: datasource with query
+        @type datasource: DataSourceConfig
+        @param consumer: query results consumer
+        @param interval: collection interval in seconds
+        @type interval: int
+        """
+        subscribers = self._subscribers.get(key, 0)
+        if subscribers < 2:
+            return connection.query(datasource, consumer)
+        # entry is [result, waiters, completed time, served tasks, expiry]
+        entry = self._results.get(key)
+        if entry is not None and entry[2] is not None and \
+            entry[3] >= subscribers:
+            self._expire(key, entry)
+            entry = None
+        if entry is None:
+            entry = self._results[key] = [None, [], None, 0, None]
+            d = connection.query(datasource, ResultSet())
+            d.addBoth(self._done, key, entry, min(self.ttl, interval / 2))
+        d = defer.Deferred()
+        d.addCallback(self._replay, consumer)
+        if entry[2] is not None:
+            self._serve(key, entry, d)
+            return d
+        call = None
+        if datasource.timeout > 0:
+            call = reactor.callLater(datasource.timeout, self._timeout,
+                                                                entry, d)
+        entry[1].append((d, call))
+        return d
+
+    def _serve(self, key, entry, d):
+        entry[3] += 1
+        if entry[3] >= self._subscribers.get(key, 0):
+            self._expire(key, entry)
+        d.callback(entry[0])
+
+    def _expire(self, key, entry):
+        """
+        Delete completed results, tasks started later run the query again.
+        """
+        call, entry[4] = entry[4], None
+        if call is not None and call.active():
+            call.cancel()
+        if self._results.get(key) is entry:
+            del self._results[key]
+
+    def _done(self, result, key, entry, ttl):
+        entry[0] = result
+        entry[2] = time.time()
+        if isinstance(result, Failure):
+            # failures are not shared with the tasks started later
+            result.cleanFailure()
+            self._expire(key, entry)
+        elif ttl > 0 and self._results.get(key) is entry:
+            entry[4] = reactor.callLater(ttl, self._expire, key, entry)
+        else:
+            self._expire(key, entry)
+        waiters, entry[1] = entry[1], []
+        for d, call in waiters:
+            if call is not None and call.active():
+                call.cancel()
+            self._serve(key, entry, d)
+
+    def _timeout(self, entry, d):
+        for waiter in entry[1]:
+            if waiter[0] is d:
+                entry[1].remove(waiter)
+                d.errback(TimeoutError('Timeout'))
+                break
+
+    def _replay(self, result, consumer):
+        consumer.start(result.header)
+        consumer.feed(result.rows)
+        return consumer
+
+SHARED_QUERIES = SharedQueries()
+
+def getSharedQueries():
+    return SHARED_QUERIES
+
+
+class StartLoad(object):
+    """
+    Number of the tasks started in every second of the collection interval.
+    """
+
+    def __init__(self):
+        self._starts = {}
+        self._peak = 0
+        self._dirty = False
+
+    def add(self, interval, startDelay):
+        key = (interval, int(startDelay) % max(interval, 1))
+        count = self._starts.get(key, 0) + 1
+        self._starts[key] = count
+        if count > self._peak:
+            self._peak = count
+
+    def remove(self, interval, startDelay):
+        key = (interval, int(startDelay) % max(interval, 1))
+        count = self._starts.get(key, 0) - 1
+        if count > 0:
+            self._starts[key] = count
+        else:
+            self._starts.pop(key, None)
+        self._dirty = True
+
+    @property
+    def peak(self):
+        """
+        Max number of the tasks started in the same second.
+        """
+        if self._dirty:
+            self._peak = max([0] + self._starts.values())
+            self._dirty = False
+        return self._peak
+
+START_LOAD = StartLoad()
+
+def getStartLoad():
+    return START_LOAD
+
+def getQueryKey(taskConfig, interval):
+    """
+    Returns key of the task query, the same for tasks of different devices
+    which run the same query on the same database.
+    """
+    datasource = taskConfig.datasources[0]
+    return (connectionKey(str(datasource.connectionString)),
+            datasource.sqlp,
+            tuple(datasource.columns),
+            interval)
+
+def getStartDelay(name, interval):
+    """
+    Returns deterministic start offset of the task in the interval.
+
+    @param name: task name or query key
+    @type name: string
+    @param interval: collection interval in seconds
+    @type interval: int
+    """
+    if interval < 2:
+        return 0
+    return (zlib.crc32(name) & 0xffffffff) % interval
+
+
+class DataPointAccumulator(object):
+    """
+    Running aggregates of the data point values from multiple rows.
+    Values are kept only for the aggregates which need all of them
+    (_median, _p95 and _distinct), _distinct counts raw column values.
+    """
+
+    def __init__(self, dp, now=None):
+        self.dp = dp
+        self._convert = compileExpression(dp.expr)
+        self._now = now or time.time()
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.first = None
+        self.last = None
+        self.mean = 0.0
+        self.m2 = 0.0
+        self._stddev = dp.id.endswith('_stddev')
+        self._distinct = dp.id.endswith('_distinct')
+        self.values = None
+        if dp.id.endswith('_median') or dp.id.endswith('_p95'):
+            self.values = []
+        elif self._distinct:
+            self.values = set()
+
+    def add(self, dpvalue):
+        """
+        Convert column value and add it to the aggregates.
+        """
+        if self._distinct:
+            if dpvalue is None or dpvalue == '': return
+            if type(dpvalue) is list: dpvalue = tuple(dpvalue)
+            self.values.add(dpvalue)
+            return
+        if dpvalue in (None, '', []):
+            return
+        elif type(dpvalue) is list:
+            dpvalue = dpvalue[0]
+        elif isinstance(dpvalue, datetime):
+            dpvalue = time.mktime(dpvalue.timetuple())
+        elif isinstance(dpvalue, timedelta):
+            dpvalue = dpvalue.seconds
+        try:
+            if self._convert:
+                dpvalue = self._convert(dpvalue, self._now)
+            value = float(dpvalue)
+        except: return
+        if not self.count:
+            self.first = self.min = self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.last = value
+        self.sum += value
+        self.count += 1
+        if self._stddev:
+            delta = value - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (value - self.mean)
+        elif self.values is not None:
+            self.values.append(value)
+
+    def getValue(self, rows):
+        """
+        Returns aggregated value.
+
+        @parameter rows: number of rows matched by datasource
+        @type rows: int
+        """
+        dpid = self.dp.id
+        if dpid.endswith('_count'): return rows
+        elif self._distinct: return len(self.values) or None
+        elif not self.count: return None
+        elif dpid.endswith('_stddev'): return (self.m2 / self.count) ** 0.5
+        elif self.count == 1: return self.first
+        elif dpid.endswith('_avg'): return self.sum / self.count
+        elif dpid.endswith('_sum'): return self.sum
+        elif dpid.endswith('_max'): return self.max
+        elif dpid.endswith('_min'): return self.min
+        elif dpid.endswith('_first'): return self.first
+        elif dpid.endswith('_last'): return self.last
+        elif dpid.endswith('_median'): return percentile(self.values, 50)
+        elif dpid.endswith('_p95'): return percentile(self.values, 95)
+        return self.sum / self.count
+
+
+class DatasourceAccumulator(object):
+    """
+    Collects rows matched by datasource keybindings in to the
+    datapoint accumulators.
+    """
+
+    def __init__(self, datasource, now=None):
+        self.datasource = datasource
+        self.rows = 0
+        self._kc, self.key = splitKeybindings(datasource.keybindings)
+        self.keys = ()
+        self.points = [DataPointAccumulator(dp, now) \
+                                            for dp in datasource.points]
+        self._points = ()
+
+    def start(self, index):
+        """
+        Resolve column indexes.
+
+        @parameter index: column name as a key and column index as a value
+        @type index: dictionary
+        """
+        self.keys = tuple([index.get(k) for k in self._kc])
+        self._points = [(acc, index[acc.dp.alias]) for acc in self.points \
+                                                    if acc.dp.alias in index]
+
+    def feed(self, row):
+        """
+        Add the row matched by keybindings.
+        """
+        self.rows += 1
+        for acc, i in self._points:
+            acc.add(row[i])
+
+
+class DatasourcesConsumer(object):
+    """
+    Query results consumer, feeds every fetched row in to the accumulators
+    of the datasources, so the rows don't have to be kept in memory.
+    Datasources are grouped by keybinding columns, so the row key is built
+    once per group and matched with a single dictionary lookup.
+    """
+
+    def __init__(self, datasources):
+        now = time.time()
+        self.results = [DatasourceAccumulator(ds, now) for ds in datasources]
+        self._groups = ()
+
+    def start(self, header):
+        index = {}
+        for i, column in enumerate(header):
+            index[column] = i
+        groups = {}
+        for result in self.results:
+            result.start(index)
+            groups.setdefault(result.keys, {}).setdefault(result.key,
+                                                        []).append(result)
+        self._groups = groups.items()
+
+    def feed(self, rows):
+        groups = self._groups
+        for row in rows:
+            for keys, results in groups:
+                for result in results.get(rowKey(row, keys), ()):
+                    result.feed(row)
 
 
 class SqlPerformanceCollectionPreferences(object):
@@ -125,9 +860,157 @@ class SqlPerformanceCollectionPreferences(object):
                           default=False,
                           help="Display the entire connection string, " \
                                " including any passwords.")
+        parser.add_option('--idletimeout',
+                          dest='idletimeout',
+                          type='int',
+                          default=IDLE_TIMEOUT,
+                          help="Close database connections which were not " \
+                               "used for this number of seconds")
+        parser.add_option('--pinginterval',
+                          dest='pinginterval',
+                          type='int',
+                          default=PING_INTERVAL,
+                          help="Interval in seconds between liveness checks " \
+                               "of idle database connections")
+        parser.add_option('--maxqueries',
+                          dest='maxqueries',
+                          type='int',
+                          default=MAX_QUERIES,
+                          help="Maximal number of concurrently running " \
+                               "queries, 0 - unlimited")
+        parser.add_option('--driverlimits',
+                          dest='driverlimits',
+                          default='',
+                          help="Maximal number of concurrently running " \
+                               "queries per DB-API module, " \
+                               "e.g. 'pywmidb=10,MySQLdb=50'")
+        parser.add_option('--fetchmin',
+                          dest='fetchmin',
+                          type='int',
+                          default=FETCH_MIN,
+                          help="Minimal number of rows fetched at once")
+        parser.add_option('--fetchmax',
+                          dest='fetchmax',
+                          type='int',
+                          default=FETCH_MAX,
+                          help="Maximal number of rows fetched at once")
+        parser.add_option('--rrdqueuesize',
+                          dest='rrdqueuesize',
+                          type='int',
+                          default=RRD_QUEUE_SIZE,
+                          help="Maximal number of per-task batches queued " \
+                               "for the RRD writer thread, above the " \
+                               "limit only the latest value of every RRD " \
+                               "file is kept, 0 - write RRD files " \
+                               "synchronously")
+        parser.add_option('--eventresyncinterval',
+                          dest='eventresyncinterval',
+                          type='int',
+                          default=EVENT_RESYNC_INTERVAL,
+                          help="Send events which don't change the status " \
+                               "of the datasource again after this number " \
+                               "of seconds, 0 - send all events")
+        parser.add_option('--workers',
+                          dest='workers',
+                          type='int',
+                          default=0,
+                          help="Number of worker processes running the " \
+                               "tasks, 0 - run tasks in the daemon process")
+        parser.add_option('--nosnapshot',
+                          dest='snapshot',
+                          action="store_false",
+                          default=True,
+                          help="Don't start collection from the local " \
+                               "snapshot of the last received configuration")
 
     def postStartup(self):
-        pass
+        getPoolManager().configure(self.options.idletimeout,
+                                    self.options.pinginterval)
+        driverLimits = parseDriverLimits(self.options.driverlimits)
+        getQueryLimiter().configure(self.options.maxqueries, driverLimits)
+        adbapiClient.fetchMin = max(self.options.fetchmin, 1)
+        adbapiClient.fetchMax = max(self.options.fetchmax, 1)
+        getRRDWriter().configure(self.options.rrdqueuesize)
+        getEventState().configure(self.options.eventresyncinterval)
+        if getattr(self.options, 'workers', 0) > 0 and \
+            getWorkerPool().count == 0:
+            options = dict(self.options.__dict__)
+            options['workers'] = 0
+            # daemon-wide query limits are split between workers
+            workers = self.options.workers
+            options['maxqueries'] = perWorkerLimit(self.options.maxqueries,
+                                                                    workers)
+            options['driverlimits'] = ','.join(['%s=%s' % (driver,
+                                perWorkerLimit(limit, workers)) \
+                                for driver, limit in driverLimits.items()])
+            script = __file__
+            if script.endswith('.pyc') or script.endswith('.pyo'):
+                script = script[:-1]
+            getWorkerPool().configure(self.options.workers,
+                                      os.path.abspath(script),
+                                      options,
+                                      {'rrd': _workerRRD,
+                                       'event': _workerEvent,
+                                       'stat': _workerStatistic})
+            getWorkerPool().start()
+
+
+def parseDriverLimits(value):
+    """
+    Returns dictionary of the --driverlimits option values.
+    """
+    driverLimits = {}
+    for limit in value.split(','):
+        if '=' not in limit: continue
+        driver, value = limit.split('=', 1)
+        try: driverLimits[driver.strip()] = int(value)
+        except ValueError:
+            log.warn("Invalid driver limit: %s", limit)
+    return driverLimits
+
+def perWorkerLimit(limit, workers):
+    """
+    Returns share of the daemon-wide limit for a single worker process,
+    0 - unlimited stays unlimited.
+    """
+    if limit <= 0 or workers <= 1:
+        return limit
+    return (limit + workers - 1) // workers
+
+
+WORKER_STATS = {}
+PARENT_STATS = ('rrdQueueDepth', 'rrdQueueFull', 'rrdValuesDropped',
+                'startLoadPeak')
+
+def _workerRRD(index, batch):
+    dataService = zope.component.queryUtility(IDataService)
+    writer = getRRDWriter()
+    writer.put(dataService, batch)
+    setStatistic('rrdQueueDepth', writer.depth)
+    setStatistic('rrdQueueFull', writer.full, 'COUNTER')
+    setStatistic('rrdValuesDropped', writer.dropped, 'COUNTER')
+
+def _workerEvent(index, event, kw):
+    zope.component.queryUtility(IEventService).sendEvent(event, **kw)
+
+def _workerStatistic(index, name, value, type):
+    """
+    Gauge is the max value of all workers, counter is the sum of all
+    workers including the values reached before worker restarts.
+    Statistics of the parent process tasks are not taken from workers.
+    """
+    if name in PARENT_STATS: return
+    # base is the sum of the counter values before worker restarts
+    stat = WORKER_STATS.setdefault((name, index), [0, 0])
+    if type == 'COUNTER' and value < stat[1]:
+        stat[0] += stat[1]
+    stat[1] = value
+    values = [WORKER_STATS.get((name, i), (0, 0)) \
+                                    for i in range(getWorkerPool().count)]
+    if type == 'COUNTER':
+        setStatistic(name, sum([base + last for base, last in values]), type)
+    else:
+        setStatistic(name, max([last for base, last in values]), type)
 
 
 STATUS_EVENT = {'eventClass' : '/Status/PyDBAPI',
@@ -143,6 +1026,10 @@ class SubConfigurationTaskSplitter(SimpleTaskSplitter):
 
     subconfigName = 'datasources'
 
+    def __init__(self, taskFactory):
+        SimpleTaskSplitter.__init__(self, taskFactory)
+        self._tasks = {}
+
     def makeConfigKey(self, config, subconfig):
         raise NotImplementedError("Required method not implemented")
 
@@ -157,6 +1044,20 @@ class SubConfigurationTaskSplitter(SimpleTaskSplitter):
         self._taskFactory.config = config
         return self._taskFactory.build()
 
+    def removeConfig(self, configId):
+        """
+        Forget tasks of the deleted configuration.
+        """
+        self._tasks.pop(configId, None)
+
+    def isCurrent(self, task):
+        """
+        Returns True if the task is the current task of its configuration.
+        Scheduler cleans the updated task up before it adds it again, the
+        cleanup of the current task must be ignored.
+        """
+        return self._tasks.get(task.configId, {}).get(task.name) is task
+
     def _splitSubConfiguration(self, config):
         subconfigs = {}
         for subconfig in getattr(config, self.subconfigName):
@@ -176,6 +1077,14 @@ class SubConfigurationTaskSplitter(SimpleTaskSplitter):
             # (including renames)
             configId = config.id
 
+            # Existing tasks with the same name are updated in place, so
+            # they keep connections and timing state. Zenoss 2 scheduler
+            # doesn't stop removed tasks, so they can't be reused.
+            oldTasks = self._tasks.get(configId, {})
+            if ZVERSION < '3.0.0':
+                oldTasks = {}
+            newTasks = {}
+
             subconfigs = self._splitSubConfiguration(config)
             for key, subconfigGroup in subconfigs.items():
                 name = ' '.join(map(str, key))
@@ -184,10 +1093,18 @@ class SubConfigurationTaskSplitter(SimpleTaskSplitter):
                 configCopy = copy(config)
                 setattr(configCopy, self.subconfigName, subconfigGroup)
 
-                tasks[name] = self._newTask(name,
-                                            configId,
-                                            interval,
-                                            configCopy)
+                task = oldTasks.get(name)
+                if task is not None and not getattr(task, 'cleaned', True):
+                    log.debug("Update task %s", name)
+                    task.updateConfig(configCopy)
+                else:
+                    task = self._newTask(name,
+                                         configId,
+                                         interval,
+                                         configCopy)
+                    task.splitter = self
+                tasks[name] = newTasks[name] = task
+            self._tasks[configId] = newTasks
         return tasks
 
 
@@ -213,6 +1130,10 @@ class SqlPerformanceCollectionTask(ObservableMixin):
     STATE_PARSE_DATA = 'PARSING_DATA'
     STATE_STORE_PERF = 'STORE_PERF_DATA'
 
+    # daemon wide overrun counters
+    overruns = 0
+    skipped = 0
+
     def __init__(self,
                  taskName,
                  configId,
@@ -236,27 +1157,67 @@ class SqlPerformanceCollectionTask(ObservableMixin):
         self.state = TaskStates.STATE_IDLE
         self.interval = scheduleIntervalSeconds
 
-        # The taskConfig corresponds to a DeviceProxy
-        self._device = taskConfig
-
-        self._devId = self._device.id
-        self._manageIp = self._device.manageIp
-
         self._dataService = zope.component.queryUtility(IDataService)
         self._eventService = zope.component.queryUtility(IEventService)
         self._preferences = zope.component.queryUtility(ICollectorPreferences,
                                                         COLLECTOR_NAME)
-        self._lastErrorMsg = ''
-        self._datasources = taskConfig.datasources
+        self.splitter = None
+        self.cleaned = False
+        self.updateConfig(taskConfig)
 
         self._connectionString = str(taskConfig.datasources[0].connectionString)
+        self._queryKey = getQueryKey(taskConfig, self.interval)
+        getSharedQueries().subscribe(self._queryKey)
+
+        # Spread start times of the tasks over the interval, the scheduler
+        # uses startDelay instead of random delay if the task has it. Tasks
+        # of the same query start together to share the query.
+        self.startDelay = getStartDelay(repr(self._queryKey), self.interval)
+        getStartLoad().add(self.interval, self.startDelay)
         self.executed = 0
+        self.durations = []
+        self._started = None
+        self._overruns = 0
+        self._skip = 0
 
     def __str__(self):
         return "SQL schedule Name: %s configId: %s Datasources: %d" % (
                self.name, self.configId, len(self._datasources))
 
+    def updateConfig(self, taskConfig):
+        """
+        Replace configuration of the task, the task keeps its connection,
+        timing and overrun state. The task name includes connection string,
+        query and interval, so the task query stays the same. Scheduler
+        removes and adds the reused task again, so cleanup of the task
+        which is still current in the task splitter is ignored.
+
+        @param taskConfig: the configuration for this task
+        """
+        # The taskConfig corresponds to a DeviceProxy
+        self._device = taskConfig
+
+        self._devId = self._device.id
+        self._manageIp = self._device.manageIp
+
+        self._lastErrorMsg = ''
+        self._datasources = taskConfig.datasources
+        for ds in self._datasources:
+            for dp in ds.points:
+                compileExpression(dp.expr)
+        self._rrdArgs = {}
+
     def cleanup(self):
+        if self.cleaned:
+            return defer.succeed(None)
+        if self.splitter is not None and self.splitter.isCurrent(self):
+            # scheduler set cleaning state before it adds the task again
+            self.state = TaskStates.STATE_IDLE
+            return defer.succeed(None)
+        self.cleaned = True
+        self._forgetEvents()
+        getEventState().forget(dict(STATUS_EVENT, device=self._devId,
+                                    eventKey='overrun|%s' % self.name))
         # Zenoss 2 ZenCollector scheduler doesn't delete task.LoopingCall after
         # tasks cleanup.
         # Workaround start
@@ -268,12 +1229,14 @@ class SqlPerformanceCollectionTask(ObservableMixin):
 
     def _cleanUpPool(self):
         """
-        Close the connection currently associated with this task.
+        Release the connection currently associated with this task, the pool
+        manager closes it once it stays idle.
         """
-        d = getConnection(self._connectionString)
-        d.addCallback(lambda conn: conn._autoclose.reset(3))
-        d.addErrback(lambda conn: None)
-        return d
+        if self._queryKey is not None:
+            getSharedQueries().unsubscribe(self._queryKey)
+            getStartLoad().remove(self.interval, self.startDelay)
+            self._queryKey = None
+        return releaseConnection(self._connectionString)
 
     def doTask(self):
         """
@@ -287,6 +1250,16 @@ class SqlPerformanceCollectionTask(ObservableMixin):
         # tasks cleanup.
         if self._lastErrorMsg == 'Task cleaned':
             return
+        # Skip the cycle if previous run is still active or task is slowed
+        # down after overruns.
+        if self._started is not None or self._skip > 0:
+            if self._started is None:
+                self._skip -= 1
+            SqlPerformanceCollectionTask.skipped += 1
+            setStatistic('tasksSkipped', self.skipped, 'COUNTER')
+            log.debug("Task %s: skip cycle", self.name)
+            return
+        self._started = time.time()
         # See if we need to connect first before doing any collection
         d = getConnection(self._connectionString)
         d.addCallback(self._fetchPerf)
@@ -322,10 +1295,12 @@ class SqlPerformanceCollectionTask(ObservableMixin):
                 log.error(msg)
 
         if reason:
-            self._eventService.sendEvent(STATUS_EVENT,
-                                     device=self._devId,
-                                     summary=msg,
-                                     severity=Event.Error)
+            self._sendEvent(dict(STATUS_EVENT,
+                                 device=self._devId,
+                                 summary=msg,
+                                 severity=Event.Error))
+        # datasource events must be sent again after recovery
+        self._forgetEvents()
         return reason
 
     def _fetchPerf(self, connection):
@@ -338,91 +1313,48 @@ class SqlPerformanceCollectionTask(ObservableMixin):
         self.state = SqlPerformanceCollectionTask.STATE_FETCH_DATA
 
         log.debug("Task %s: Query: %s", self.name, self._datasources[0].sqlp)
-        d = connection.query(self._datasources[0])
+        d = getSharedQueries().query(self._queryKey,
+                                connection, self._datasources[0],
+                                DatasourcesConsumer(self._datasources),
+                                self.interval)
         d.addCallback(self._parseResults, connection)
         d.addCallback(self._storeResults)
         d.addCallback(self._updateStatus)
         return d
 
-    def _processDatasourceResults(self, datasource, results=[]):
+    def _processDatasourceResults(self, datasource, results):
         """
         Process a single datasource's result
 
         @parameter datasource: datasource
         @type datasource: DataSourceConfig object
-        @parameter results: results rows
-        @type results: list
+        @parameter results: accumulated datasource results
+        @type results: DatasourceAccumulator
         """
         msg = 'Datasource %s query completed successfully' % (datasource.name)
-        if datasource.keybindings:
-            kc, kv = zip(*[map(lambda v: str(v).strip().lower(), k) \
-                            for k in datasource.keybindings.iteritems()])
-            kv = ''.join(kv)
-        else: kc, kv = (), ''
-        dsresult = []
-        for row in results:
-            if ''.join([str(row.get(k) or '').strip() for k in kc]
-                ).lower() != kv: continue
-            dsresult.append(row)
         result = ParsedResults()
         ev = self._makeQueryEvent(datasource, msg, Clear)
         result.events.append(ev)
-        for dp in datasource.points:
-            values = []
-            for row in dsresult:
-                dpvalue = row.get(dp.alias, None)
-                if dpvalue in (None, '', []):
-                    continue
-                elif type(dpvalue) is list:
-                    dpvalue = dpvalue[0]
-                elif isinstance(dpvalue, datetime):
-                    dpvalue = time.mktime(dpvalue.timetuple())
-                elif isinstance(dpvalue, timedelta):
-                    dpvalue = dpvalue.seconds
-                try:
-                    if dp.expr:
-                        if dp.expr.__contains__(':'):
-                            ed = eval('{%s}'%dp.expr.lower())
-                            if isinstance(dpvalue, float):
-                                dpvalue = int(dpvalue)
-                            dpvalue = ed.get(str(dpvalue).lower()) or ed.get(
-                                                                    'unknown')
-                        else:
-                            dpvalue = rrpn(dp.expr, dpvalue)
-                    values.append(float(dpvalue))
-                except: continue
-            if dp.id.endswith('_count'): value = len(dsresult)
-            elif not values: value = None
-            elif len(values) == 1: value = values[0]
-            elif dp.id.endswith('_avg'):value = sum(values) / len(values)
-            elif dp.id.endswith('_sum'): value = sum(values)
-            elif dp.id.endswith('_max'): value = max(values)
-            elif dp.id.endswith('_min'): value = min(values)
-            elif dp.id.endswith('_first'): value = values[0]
-            elif dp.id.endswith('_last'): value = values[-1]
-            else: value = sum(values) / len(values)
-            result.values.append((dp, value))
+        for acc in results.points:
+            result.values.append((acc.dp, acc.getValue(results.rows)))
         return datasource, result
 
-    def _parseResults(self, results, connection):
+    def _parseResults(self, consumer, connection):
         """
         Interpret the results retrieved from the commands and pass on
         the datapoint values and events.
 
-        @parameter results: results rows
-        @type results: list
+        @parameter consumer: accumulated results
+        @type consumer: DatasourcesConsumer
         """
-        if connection._autoclose.active():
-            connection._autoclose.reset(self.interval * 2)
-        else:
-            return defer.fail("Connection lost")
+        connection.touch(self.interval * 2)
 
         self.state = SqlPerformanceCollectionTask.STATE_PARSE_DATA
         parseableResults = []
 
-        for ds in self._datasources:
-            d = defer.succeed(ds)
-            d.addCallback(self._processDatasourceResults, results)
+        for result in consumer.results:
+            d = defer.succeed(result.datasource)
+            d.addCallback(self._processDatasourceResults, result)
             parseableResults.append(d)
         return defer.gatherResults(parseableResults)
 
@@ -434,27 +1366,41 @@ class SqlPerformanceCollectionTask(ObservableMixin):
         @type resultList: array of (datasource, dictionary)
         """
         self.state = SqlPerformanceCollectionTask.STATE_STORE_PERF
+        batch = []
         for datasource, results in resultList:
             for dp, value in results.values:
                 if value in (None, ''):
                     value = 0
-                args = [dp.rrdPath,
-                        value,
-                        dp.rrdType,
-                        dp.rrdCreateCommand,
-                        datasource.cycleTime,
-                        dp.rrdMin,
-                        dp.rrdMax]
-                if ZVERSION > '3.1.0':
-                    threshData = {
-                        'eventKey': datasource.getEventKey(dp),
-                        'component': dp.component,
-                        }
-                    args.append(threshData)
-                self._dataService.writeRRD(*args)
-
+                args = self._rrdArgs.get(id(dp))
+                if args is None:
+                    args = self._rrdArgs[id(dp)] = self._makeRRDArgs(
+                                                            datasource, dp)
+                batch.append((args[0], value) + args[1:])
+        writer = getRRDWriter()
+        writer.put(self._dataService, batch)
+        setStatistic('rrdQueueDepth', writer.depth)
+        setStatistic('rrdQueueFull', writer.full, 'COUNTER')
+        setStatistic('rrdValuesDropped', writer.dropped, 'COUNTER')
         return resultList
 
+    def _makeRRDArgs(self, datasource, dp):
+        """
+        Returns writeRRD arguments of the data point except the value.
+        """
+        args = (dp.rrdPath,
+                dp.rrdType,
+                dp.rrdCreateCommand,
+                datasource.cycleTime,
+                dp.rrdMin,
+                dp.rrdMax)
+        if ZVERSION > '3.1.0':
+            threshData = {
+                'eventKey': datasource.getEventKey(dp),
+                'component': dp.component,
+                }
+            args += (threshData,)
+        return args
+
     def _updateStatus(self, resultList):
         """
         Send any accumulated events
@@ -464,9 +1410,26 @@ class SqlPerformanceCollectionTask(ObservableMixin):
         """
         for datasource, results in resultList:
             for ev in results.events:
-                self._eventService.sendEvent(ev, device=self._devId)
+                self._sendEvent(ev)
+        setStatistic('eventsSuppressed', getEventState().suppressed, 'COUNTER')
         return resultList
 
+    def _sendEvent(self, event):
+        """
+        Send event if it changes the status.
+        """
+        event['device'] = self._devId
+        if getEventState().changed(event):
+            self._eventService.sendEvent(event, device=self._devId)
+
+    def _forgetEvents(self):
+        """
+        Forget the last sent states of the datasource events.
+        """
+        eventState = getEventState()
+        for datasource in self._datasources:
+            eventState.forget(self._makeQueryEvent(datasource, ''))
+
     def _makeQueryEvent(self, datasource, msg, severity=None):
         """
         Create an event using the info in the DataSourceConfig object.
@@ -495,11 +1458,411 @@ class SqlPerformanceCollectionTask(ObservableMixin):
             log.warn("Failed to close device %s: error %s" %
                      (self._devId, str(ex)))
 
+        self._checkOverrun()
+        setStatistic('queryTimeouts', getWatchdog().expired, 'COUNTER')
+        setStatistic('startLoadPeak', getStartLoad().peak)
+
         # Return the result so the framework can track success/failure
         return result
 
+    def _checkOverrun(self):
+        """
+        Track task duration, skip up to MAX_SKIP cycles with exponential
+        backoff if the task overruns the interval OVERRUN_LIMIT times in a row.
+        The task skips at least as many cycles as the average duration of its
+        last DURATION_HISTORY runs requires to complete within the skipped
+        cycles.
+        """
+        if self._started is None: return
+        duration = time.time() - self._started
+        self._started = None
+        self.durations.append(duration)
+        del self.durations[:-DURATION_HISTORY]
+        event = dict(STATUS_EVENT, eventKey='overrun|%s' % self.name)
+        if duration <= self.interval:
+            if self._overruns >= OVERRUN_LIMIT:
+                event['summary'] = 'Task %s completed in %.1f seconds' % (
+                                                        self.name, duration)
+                event['severity'] = Clear
+                self._sendEvent(event)
+            self._overruns = 0
+            return
+        self._overruns += 1
+        SqlPerformanceCollectionTask.overruns += 1
+        setStatistic('taskOverruns', self.overruns, 'COUNTER')
+        if self._overruns < OVERRUN_LIMIT: return
+        average = sum(self.durations) / len(self.durations)
+        self._skip = min(max(2 ** (self._overruns - OVERRUN_LIMIT),
+                            int(average // max(self.interval, 1))), MAX_SKIP)
+        msg = 'Task %s took %.1f seconds, longer than %s seconds interval, ' \
+              'skip %s cycles' % (self.name, duration, self.interval,
+                                  self._skip)
+        log.warn(msg)
+        event['summary'] = msg
+        event['severity'] = Warning
+        self._sendEvent(event)
+
+
+class SqlWorkerTask(ObservableMixin):
+    """
+    Proxy of the SqlPerformanceCollectionTask running in a worker process.
+    """
+    zope.interface.implements(IScheduledTask)
+
+    def __init__(self,
+                 taskName,
+                 configId,
+                 scheduleIntervalSeconds,
+                 taskConfig):
+        """
+        @param taskName: the unique identifier for this task
+        @type taskName: string
+        @param configId: configuration to watch
+        @type configId: string
+        @param scheduleIntervalSeconds: the interval at which this task will be
+               collected
+        @type scheduleIntervalSeconds: int
+        @param taskConfig: the configuration for this task
+        """
+        super(SqlWorkerTask, self).__init__()
+        self.name = taskName
+        self.configId = configId
+        self.state = TaskStates.STATE_IDLE
+        self.interval = scheduleIntervalSeconds
+        self.startDelay = getStartDelay(repr(getQueryKey(taskConfig,
+                                scheduleIntervalSeconds)), self.interval)
+        getStartLoad().add(self.interval, self.startDelay)
+        self.splitter = None
+        self.cleaned = False
+        self.updateConfig(taskConfig)
+
+    def __str__(self):
+        return "SQL worker task %s" % self.name
+
+    def updateConfig(self, taskConfig):
+        """
+        Send new configuration to the worker, cleanup of the task which is
+        still current in the task splitter is ignored.
+        """
+        # tasks of the same query run in the same worker to share it
+        key = repr(getQueryKey(taskConfig, self.interval))
+        self._generation = getWorkerPool().addTask(key, self.name,
+                                    self.configId, self.interval, taskConfig)
+
+    def cleanup(self):
+        if self.cleaned:
+            return defer.succeed(None)
+        if self.splitter is not None and self.splitter.isCurrent(self):
+            # scheduler set cleaning state before it adds the task again
+            self.state = TaskStates.STATE_IDLE
+            return defer.succeed(None)
+        self.cleaned = True
+        getWorkerPool().removeTask(self.name, self._generation)
+        getStartLoad().remove(self.interval, self.startDelay)
+        return defer.succeed(None)
+
+    def doTask(self):
+        d = getWorkerPool().run(self.name)
+        d.addBoth(self._finished)
+        return d
+
+    def _finished(self, result):
+        setStatistic('startLoadPeak', getStartLoad().peak)
+        return result
+
+
+class WorkerStatistic(object):
+    """
+    Daemon statistic of the worker process, sends value to the parent.
+    """
+
+    def __init__(self, services, name, type):
+        self._services = services
+        self.name = name
+        self.type = type
+        self._value = 0
+
+    def _getValue(self):
+        return self._value
+
+    def _setValue(self, value):
+        self._value = value
+        self._services.connection.send('stat', self.name, value, self.type)
+
+    value = property(_getValue, _setValue)
+
+
+class WorkerServices(object):
+    """
+    Data, event and statistics services of the worker process, forwards
+    RRD values, events and statistics to the parent process.
+    """
+    if IStatisticsService is None:
+        zope.interface.implements(IDataService, IEventService)
+    else:
+        zope.interface.implements(IDataService, IEventService,
+                                  IStatisticsService)
+
+    def __init__(self):
+        self.connection = None
+        self.tasks = {}
+        self._rrd = []
+        self._stats = {}
+
+    def writeRRD(self, *args):
+        if not self._rrd:
+            reactor.callLater(0, self._flushRRD)
+        self._rrd.append(args)
+
+    def _flushRRD(self):
+        batch, self._rrd = self._rrd, []
+        self.connection.send('rrd', batch)
+
+    def sendEvent(self, event, **kw):
+        self.connection.send('event', event, kw)
+        return defer.succeed(None)
+
+    def addStatistic(self, name, type):
+        self._stats[name] = WorkerStatistic(self, name, type)
+
+    def getStatistic(self, name):
+        return self._stats[name]
+
+    def received(self, message):
+        """
+        Handle message from the parent process.
+        """
+        if message[0] == 'options':
+            preferences = SqlPerformanceCollectionPreferences()
+            preferences.options = Values(message[1])
+            logging.getLogger().setLevel(getattr(preferences.options,
+                                                'logseverity', logging.WARN))
+            # parent process writes RRD files
+            preferences.options.rrdqueuesize = 0
+            zope.component.provideUtility(preferences, ICollectorPreferences,
+                                          COLLECTOR_NAME)
+            preferences.postStartup()
+        elif message[0] == 'config':
+            name, configId, interval, config = message[1:]
+            task = self.tasks.get(name)
+            if task is not None and not task.cleaned:
+                # only the parent sends cleanup of the reused task
+                task.updateConfig(config)
+                return
+            self.tasks[name] = SqlPerformanceCollectionTask(name, configId,
+                                                            interval, config)
+        elif message[0] == 'cleanup':
+            if message[1] in self.tasks:
+                self.tasks.pop(message[1]).cleanup()
+        elif message[0] == 'run':
+            task = self.tasks.get(message[1])
+            if task is None:
+                self.connection.send('done', message[1], None)
+                return
+            d = defer.maybeDeferred(task.doTask)
+            d.addCallbacks(self._done, self._done, (message[1],), None,
+                                                    (message[1],), None)
+
+    def _done(self, result, name):
+        error = None
+        if isinstance(result, Failure):
+            error = result.getErrorMessage()
+        if self._rrd:
+            self._flushRRD()
+        self.connection.send('done', name, error)
+
+
+class SqlCollectorDaemon(CollectorDaemon):
+    """
+    Collector daemon which keeps the snapshot of the received device
+    configurations on disk and starts collection from it before the
+    configurations are loaded from zenhub.
+    """
+
+    def __init__(self, preferences, taskSplitter, *args, **kwargs):
+        CollectorDaemon.__init__(self, preferences, taskSplitter,
+                                                        *args, **kwargs)
+        self._sqlPreferences = preferences
+        self._sqlTaskSplitter = taskSplitter
+        self._snapshot = {}
+        self._snapshotDevices = None
+        self._snapshotCall = None
+        self._snapshotLock = defer.DeferredLock()
+        self._snapshotQueued = None
+        self._loadingSnapshot = False
+        self._rrdBuffer = {}
+        self._rrdLock = threading.Lock()
+        self._snapshotPath = zenPath('var', '%s_%s_configs.pickle' % (
+                        COLLECTOR_NAME, getattr(self.options, 'monitor', '')))
+        if getattr(self.options, 'snapshot', False):
+            reactor.callWhenRunning(self._loadSnapshot)
+            reactor.addSystemEventTrigger('before', 'shutdown',
+                                                    self._saveSnapshot)
+
+    def _loadSnapshot(self):
+        """
+        Schedule tasks of the device configurations from the snapshot.
+        """
+        if self._snapshotDevices is not None or self._snapshot: return
+        try:
+            f = open(self._snapshotPath, 'rb')
+            try:
+                snapshot = cPickle.load(f)
+            finally:
+                f.close()
+        except IOError:
+            return
+        except Exception, ex:
+            log.warn("Failed to load configuration snapshot %s: %s",
+                                                    self._snapshotPath, ex)
+            return
+        if not isinstance(snapshot, dict) or \
+            snapshot.get('version') != SNAPSHOT_VERSION:
+            log.info("Ignore configuration snapshot of another version")
+            return
+        self._sqlPreferences.postStartup()
+        configs = snapshot.get('configs', {})
+        log.info("Start collection from snapshot of %s devices", len(configs))
+        self._loadingSnapshot = True
+        try:
+            for cfg in configs.values():
+                try:
+                    self._updateConfig(cfg)
+                except Exception:
+                    log.exception("Failed to load configuration of %s",
+                                                                cfg.id)
+        finally:
+            self._loadingSnapshot = False
+        self._snapshot.update(configs)
+        self._snapshotDevices = set(configs.keys())
+
+    def _saveSnapshot(self):
+        """
+        Write snapshot of the device configurations in a thread, returns
+        deferred which fires when the snapshot is written. Only one write
+        runs at a time, the next write waits for it.
+        """
+        if self._snapshotCall is not None and self._snapshotCall.active():
+            self._snapshotCall.cancel()
+        self._snapshotCall = None
+        if not getattr(self.options, 'snapshot', False):
+            return defer.succeed(None)
+        if self._snapshotQueued is not None:
+            return self._snapshotQueued
+        d = self._snapshotQueued = defer.Deferred()
+        self._snapshotLock.run(self._writeSnapshot).chainDeferred(d)
+        return d
+
+    def _writeSnapshot(self):
+        self._snapshotQueued = None
+        snapshot = {'version': SNAPSHOT_VERSION,
+                    'time': time.time(),
+                    'configs': dict(self._snapshot)}
+        def _failed(reason):
+            log.warn("Failed to save configuration snapshot %s: %s",
+                            self._snapshotPath, reason.getErrorMessage())
+        d = threads.deferToThread(self._dumpSnapshot, snapshot)
+        d.addErrback(_failed)
+        return d
+
+    def _dumpSnapshot(self, snapshot):
+        """
+        Write snapshot atomically, readable only by the daemon user, as
+        configurations contain passwords.
+        """
+        tmpPath = '%s.tmp' % self._snapshotPath
+        try: os.unlink(tmpPath)
+        except OSError: pass
+        fd = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        f = os.fdopen(fd, 'wb')
+        try:
+            cPickle.dump(snapshot, f, 2)
+        finally:
+            f.close()
+        os.rename(tmpPath, self._snapshotPath)
+
+    def _snapshotChanged(self):
+        if self._loadingSnapshot: return
+        if self._snapshotCall is None or not self._snapshotCall.active():
+            self._snapshotCall = reactor.callLater(SNAPSHOT_DELAY,
+                                                    self._saveSnapshot)
+
+    def _updateConfig(self, cfg):
+        result = CollectorDaemon._updateConfig(self, cfg)
+        self._snapshot[cfg.id] = cfg
+        self._snapshotChanged()
+        return result
+
+    def _deleteDevice(self, deviceId):
+        result = CollectorDaemon._deleteDevice(self, deviceId)
+        removeConfig = getattr(self._sqlTaskSplitter, 'removeConfig', None)
+        if removeConfig is not None:
+            removeConfig(deviceId)
+        if self._snapshot.pop(deviceId, None) is not None:
+            self._snapshotChanged()
+        return result
+
+    def _updateDeviceConfigs(self, updatedConfigs, *args):
+        """
+        Delete devices of the snapshot which were not received from zenhub
+        with the first full configuration.
+        """
+        result = CollectorDaemon._updateDeviceConfigs(self, updatedConfigs,
+                                                                    *args)
+        if self._snapshotDevices is not None and (not args or args[0]):
+            received = set([cfg.id for cfg in updatedConfigs])
+            for deviceId in self._snapshotDevices - received:
+                log.debug("Delete snapshot device %s", deviceId)
+                self._deleteDevice(deviceId)
+            self._snapshotDevices = None
+        return result
+
+    def writeRRD(self, path, *args, **kwargs):
+        """
+        Buffer the latest values of RRD files until RRD is configured by
+        zenhub preferences.
+        """
+        self._rrdLock.acquire()
+        try:
+            if getattr(self, '_rrd', True) is None:
+                if len(self._rrdBuffer) < RRD_BUFFER_SIZE or \
+                    path in self._rrdBuffer:
+                    self._rrdBuffer[path] = (args, kwargs)
+                return
+            buffered, self._rrdBuffer = self._rrdBuffer, {}
+        finally:
+            self._rrdLock.release()
+        for bpath, (bargs, bkwargs) in buffered.items():
+            if bpath == path: continue
+            try:
+                CollectorDaemon.writeRRD(self, bpath, *bargs, **bkwargs)
+            except Exception:
+                log.exception("Failed to write RRD %s", bpath)
+        return CollectorDaemon.writeRRD(self, path, *args, **kwargs)
+
+
+def runWorker():
+    """
+    Run tasks received from the parent zenperfsql process.
+    """
+    logging.basicConfig(level=logging.WARN,
+                format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    services = WorkerServices()
+    zope.component.provideUtility(services, IDataService)
+    zope.component.provideUtility(services, IEventService)
+    if IStatisticsService is not None:
+        zope.component.provideUtility(services, IStatisticsService)
+    services.connection = connectParent(services.received)
+    reactor.run()
+
+
+if __name__ == '__main__' and '--worker' in sys.argv:
+    # Required for passing classes from zenhub to here
+    from ZenPacks.community.SQLDataSource.SQLClient import DataSourceConfig,\
+                                                            DataPointConfig
+    runWorker()
 
-if __name__ == '__main__':
+elif __name__ == '__main__':
     # Required for passing classes from zenhub to here
     from ZenPacks.community.SQLDataSource.SQLClient import DataSourceConfig,\
                                                             DataPointConfig
@@ -507,6 +1870,8 @@ if __name__ == '__main__':
     myPreferences = SqlPerformanceCollectionPreferences()
     myTaskFactory = SimpleTaskFactory(SqlPerformanceCollectionTask)
     myTaskSplitter = SqlPerCycletimeTaskSplitter(myTaskFactory)
-    daemon = CollectorDaemon(myPreferences, myTaskSplitter)
+    daemon = SqlCollectorDaemon(myPreferences, myTaskSplitter)
+    if daemon.options.workers > 0:
+        myTaskFactory.factory = SqlWorkerTask
     daemon.run()
 